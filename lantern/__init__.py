@@ -3,4 +3,11 @@
 """
 
 from .client import *
+from .async_client import *
+from .cache import *
+from .pool import *
+from .filters import *
+from .instrumentation import *
+from .quantization import *
+from .partitions import *
 from .utils import *
@@ -0,0 +1,401 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from typing import List, Optional, Union
+from .client import HNSWIndex, QueryBuilder
+from .utils import (
+    get_vector_result,
+    get_output_result,
+    check_output_type,
+    prepare_insert_data,
+    get_copy_chunks,
+    get_update_copy_line,
+    get_select_fields,
+    translate_to_pyformat,
+    max_db_connections_query,
+    get_cached_max_db_connections,
+    cache_max_db_connections,
+    get_session_settings_query,
+    forget_session_settings,
+    parse_real_array,
+    real_array_oid,
+)
+
+_real_array_loader = None
+
+
+def _get_real_array_loader():
+    global _real_array_loader
+    if _real_array_loader is None:
+        from psycopg.adapt import Loader
+
+        class RealArrayLoader(Loader):
+            def load(self, data):
+                return parse_real_array(bytes(data).decode("ascii"))
+
+        _real_array_loader = RealArrayLoader
+    return _real_array_loader
+
+
+class AsyncClient:
+    """
+    asyncio counterpart of `SyncClient`.
+
+    Queries are built with the same `QueryBuilder` and decoded with the same
+    result helpers, but are executed on psycopg 3 connections checked out from
+    a `psycopg_pool.AsyncConnectionPool`, so many searches can be in flight on
+    a single event loop.
+
+    Only the core table, write and search methods are available, and tables
+    created with `quantization` or `partition_key` are not supported.
+
+    Requires the `async` extra: `pip install lantern-client[async]`
+    """
+
+    def __init__(
+        self,
+        table_name: str,
+        dimensions: int,
+        url: Optional[str] = None,
+        pool=None,
+        distance_type: str = "cosine",
+        max_db_connections: Optional[int] = None,
+        id_type: str = "TEXT",
+        m: Optional[int] = 12,
+        ef: Optional[int] = 64,
+        ef_construction: Optional[int] = 64,
+        prepare: bool = False,
+        numpy_embeddings: bool = False,
+    ) -> None:
+        self.builder = QueryBuilder(table_name, dimensions, id_type, distance_type)
+        self.db_url = url
+        self.pool = pool
+        # concurrent first calls must share the pool the first of them opens,
+        # the lock is created in open() so it binds to the running event loop
+        self._open_lock = None
+        self.dimensions = dimensions
+        self.table_name = table_name
+        self.max_db_connections = max_db_connections
+        self.m = m
+        self.ef = ef
+        self.ef_construction = ef_construction
+        # psycopg 3 manages per-connection prepared statements itself,
+        # prepare=True makes it prepare the hot queries on first use
+        self.prepare = prepare or None
+        self.numpy_embeddings = numpy_embeddings
+        # search-time ef, e.g. from `SyncClient.tune_ef`, None uses the ef of the index
+        self.search_ef = None
+
+    async def _probe_max_db_connections(self, pool):
+        # runs on the first pooled connection instead of a dedicated one
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(max_db_connections_query)
+                num_connections = (await cur.fetchone())[0]
+        return cache_max_db_connections(self.db_url, num_connections)
+
+    async def open(self):
+        if self.pool is not None:
+            return
+
+        if self._open_lock is None:
+            self._open_lock = asyncio.Lock()
+        async with self._open_lock:
+            if self.pool is None:
+                self.pool = await self._open_pool()
+
+    async def _open_pool(self):
+        from psycopg_pool import AsyncConnectionPool
+
+        if self.max_db_connections is None:
+            self.max_db_connections = get_cached_max_db_connections(self.db_url)
+
+        pool = AsyncConnectionPool(
+            self.db_url,
+            min_size=1,
+            max_size=self.max_db_connections or 1,
+            open=False,
+        )
+        await pool.open()
+        if self.max_db_connections is None:
+            try:
+                self.max_db_connections = await self._probe_max_db_connections(pool)
+            except:
+                await pool.close()
+                raise
+            await pool.resize(1, self.max_db_connections)
+        return pool
+
+    @asynccontextmanager
+    async def connect(self):
+        if self.pool is None:
+            await self.open()
+
+        async with self.pool.connection() as connection:
+            try:
+                yield connection
+            except:
+                forget_session_settings(connection)
+                raise
+
+    async def _apply_search_settings(self, conn, cur, limit, ef=None, init_k=None):
+        # psycopg 3 can not send several statements together with parameters,
+        # so the SETs are only executed when the connection needs them
+        ef = self.search_ef if ef is None else ef
+        settings = get_session_settings_query(
+            conn,
+            {
+                "lantern_hnsw.init_k": int(limit if init_k is None else init_k),
+                "lantern_hnsw.ef": None if ef is None else int(ef),
+                "enable_seqscan": "off",
+            },
+        )
+        if settings != "":
+            await cur.execute(settings)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def _cursor(self, conn, output="dotdict"):
+        cur = conn.cursor()
+        if self.numpy_embeddings or output == "numpy":
+            cur.adapters.register_loader(real_array_oid, _get_real_array_loader())
+        return cur
+
+    def _embedding_param(self, embedding):
+        # psycopg 3 sends python floats as float8[], which lantern's real[]
+        # operators do not accept, so the values are tagged as float4
+        if embedding is None or self.builder.distance_type == "hamming":
+            return embedding
+
+        from psycopg.types.numeric import Float4
+
+        return [Float4(v) for v in embedding]
+
+    def _insert_values(self, row):
+        id, embedding, metadata = prepare_insert_data(row)
+        return (id, self._embedding_param(embedding), metadata)
+
+    async def exists(self):
+        async with self.connect() as conn:
+            async with conn.cursor() as cur:
+                try:
+                    await cur.execute(self.builder.row_exists_query())
+                    await cur.fetchall()
+                    return True
+                except:
+                    return False
+
+    async def create_table(self):
+        query = self.builder.get_create_query()
+        async with self.connect() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query)
+
+    async def create_index(self):
+        hnsw_index = HNSWIndex(
+            dim=self.dimensions,
+            m=self.m,
+            ef_construction=self.ef_construction,
+            ef_search=self.ef,
+        )
+        hnsw_query = self.builder.create_embedding_index_query(hnsw_index)
+        meta_query = self.builder.create_metadata_index_query()
+        async with self.connect() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(hnsw_query)
+                await cur.execute(meta_query)
+
+    async def upsert(self, data, update=False):
+        if data is None or len(data) == 0:
+            raise (Exception("Data can not be empty"))
+
+        query = self.builder.get_upsert_query("(%s, %s, %s)", update=update)
+
+        async with self.connect() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, self._insert_values(data))
+
+    async def upsert_many(self, data, update=False):
+        if data is None or len(data) == 0:
+            raise (Exception("Data can not be empty"))
+
+        query = self.builder.get_upsert_query("(%s, %s, %s)", update=update)
+
+        values = list(map(self._insert_values, data))
+
+        async with self.connect() as conn:
+            async with conn.cursor() as cur:
+                await cur.executemany(query, values)
+
+    async def bulk_insert(self, rows, chunk_size=10000, progress=None):
+        async with self.connect() as conn:
+            async with conn.cursor() as cur:
+                async with cur.copy(self.builder.get_copy_query()) as copy:
+                    for chunk in get_copy_chunks(rows, chunk_size, progress):
+                        await copy.write(chunk)
+
+    async def bulk_upsert(self, rows, chunk_size=10000, progress=None):
+        staging_table = self.builder._get_staging_table_name()
+        async with self.connect() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(self.builder.create_staging_table_query())
+                copy_query = self.builder.get_copy_query(table_name=staging_table)
+                async with cur.copy(copy_query) as copy:
+                    for chunk in get_copy_chunks(rows, chunk_size, progress):
+                        await copy.write(chunk)
+                await cur.execute(self.builder.merge_staging_table_query())
+                return cur.rowcount
+
+    async def update_by_id(self, id, embedding=None, metadata=None):
+        query = self.builder.get_update_by_id_query(embedding, metadata)
+        if metadata is not None:
+            metadata = json.dumps(metadata)
+
+        params = tuple(
+            filter(
+                lambda x: x is not None,
+                [id, self._embedding_param(embedding), metadata],
+            )
+        )
+        query, params = translate_to_pyformat(query, params)
+        async with self.connect() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, params)
+
+    async def update_many(
+        self, rows, merge_metadata=False, chunk_size=10000, progress=None
+    ):
+        staging_table = self.builder._get_update_staging_table_name()
+        async with self.connect() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(self.builder.create_update_staging_table_query())
+                copy_query = self.builder.get_copy_query(table_name=staging_table)
+                async with cur.copy(copy_query) as copy:
+                    for chunk in get_copy_chunks(
+                        rows, chunk_size, progress, get_update_copy_line
+                    ):
+                        await copy.write(chunk)
+                await cur.execute(
+                    self.builder.update_from_staging_table_query(merge_metadata)
+                )
+                return cur.rowcount
+
+    async def delete_by_ids(self, ids):
+        query, params = self.builder.delete_by_ids_query(ids)
+        query, params = translate_to_pyformat(query, params)
+        async with self.connect() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, params)
+
+    async def drop(self):
+        query = self.builder.delete_table_query()
+        async with self.connect() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query)
+
+    async def get_by_id(self, id, select_fields=[]):
+        query = self.builder.get_by_id_query(get_select_fields(select_fields))
+        params = id if isinstance(id, (list, tuple)) else [id]
+        query, params = translate_to_pyformat(query, params)
+        async with self.connect() as conn:
+            async with self._cursor(conn) as cur:
+                await cur.execute(query, params, prepare=self.prepare)
+                return get_vector_result(await cur.fetchall(), select_fields, True)
+
+    async def get_by_ids(self, ids=[], select_fields=[], output="dotdict"):
+        check_output_type(output)
+        query, params = self.builder.get_by_ids_query(
+            get_select_fields(select_fields), ids
+        )
+        query, params = translate_to_pyformat(query, params)
+        async with self.connect() as conn:
+            async with self._cursor(conn, output) as cur:
+                await cur.execute(query, params, prepare=self.prepare)
+                return get_output_result(
+                    await cur.fetchall(),
+                    select_fields,
+                    output,
+                    self.dimensions,
+                    with_distance=False,
+                )
+
+    async def count(self):
+        query = self.builder.get_count_query()
+        async with self.connect() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query)
+                return (await cur.fetchall())[0][0]
+
+    async def search(
+        self,
+        query_id: Optional[str] = None,
+        query_embedding: Optional[List[Union[float, int]]] = None,
+        limit: Optional[int] = 10,
+        filter: Optional[dict] = None,
+        select_fields: Optional[List[str]] = [],
+        output: str = "dotdict",
+        ef: Optional[int] = None,
+        init_k: Optional[int] = None,
+    ):
+        check_output_type(output)
+        if not query_id and query_embedding is None:
+            raise (
+                Exception(
+                    "Please provide 'query_id' or 'query_embedding' argument for search"
+                )
+            )
+        query, params = self.builder.search_query(
+            None if query_id else self._embedding_param(query_embedding),
+            limit=limit,
+            filter=filter,
+            select=select_fields,
+            query_id=query_id or None,
+        )
+        query, params = translate_to_pyformat(query, params)
+        async with self.connect() as conn:
+            async with self._cursor(conn, output) as cur:
+                await self._apply_search_settings(conn, cur, limit, ef, init_k)
+                await cur.execute(query, params, prepare=self.prepare)
+                return get_output_result(
+                    await cur.fetchall(), select_fields, output, self.dimensions
+                )
+
+    async def search_many(
+        self,
+        query_embeddings: List[List[Union[float, int]]],
+        limit: Optional[int] = 10,
+        filter: Optional[dict] = None,
+        select_fields: Optional[List[str]] = [],
+        output: str = "dotdict",
+        ef: Optional[int] = None,
+        init_k: Optional[int] = None,
+    ):
+        check_output_type(output)
+        if len(query_embeddings) == 0:
+            return []
+
+        query, params = self.builder.search_many_query(
+            query_embeddings, limit=limit, filter=filter, select=select_fields
+        )
+        query, params = translate_to_pyformat(query, params)
+        results = [[] for _ in range(len(query_embeddings))]
+        async with self.connect() as conn:
+            async with self._cursor(conn, output) as cur:
+                await self._apply_search_settings(conn, cur, limit, ef, init_k)
+                await cur.execute(query, params, prepare=self.prepare)
+                for row in await cur.fetchall():
+                    results[row[0] - 1].append(row[1:])
+
+        return [
+            get_output_result(rows, select_fields, output, self.dimensions)
+            for rows in results
+        ]
@@ -0,0 +1,332 @@
+"""
+Recall and latency benchmark for lantern HNSW indexes.
+
+Loads a dataset into a table, builds the index for every configuration of a
+parameter sweep and reports recall@k against exact NumPy ground truth,
+queries per second and latency percentiles. Run it against a local Postgres
+with the lantern extension:
+
+    python -m lantern.benchmark --url postgres://postgres@localhost/postgres \\
+        --rows 100000 --dimensions 128 --m 8,16 --ef-construction 64,128 \\
+        --ef 32,64,128 --output results.json
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import platform
+import sys
+import time
+import numpy as np
+from typing import List, Optional
+from .client import HNSWIndex, QueryBuilder, SyncClient
+from .utils import dotdict
+
+
+def get_distance_type(distance_type):
+    return QueryBuilder("", 0, "TEXT", distance_type).distance_type
+
+
+def check_distance_type(distance_type):
+    # hamming indexes need an INTEGER[] column, the client tables are REAL[]
+    if get_distance_type(distance_type) == "hamming":
+        raise (Exception("The benchmark supports l2sq and cosine distances"))
+
+
+def generate_dataset(
+    num_rows, dimensions, num_queries=1000, distance_type="l2sq", seed=0
+):
+    """Generates standard normal float32 `embeddings` and `queries` matrices."""
+    check_distance_type(distance_type)
+    rng = np.random.default_rng(seed)
+    return dotdict(
+        {
+            "embeddings": rng.standard_normal((num_rows, dimensions), np.float32),
+            "queries": rng.standard_normal((num_queries, dimensions), np.float32),
+        }
+    )
+
+
+def load_dataset(path):
+    """
+    Loads a dataset from a `.npz` file with `embeddings` and `queries` arrays.
+    A `ground_truth` array of neighbor indices is used as is when present.
+    """
+    with np.load(path) as data:
+        dataset = dotdict(
+            {"embeddings": data["embeddings"], "queries": data["queries"]}
+        )
+        if "ground_truth" in data:
+            dataset.ground_truth = data["ground_truth"]
+    return dataset
+
+
+def exact_distances(queries, embeddings, distance_type="l2sq"):
+    """Returns the (queries, embeddings) matrix of exact distances."""
+    check_distance_type(distance_type)
+    distance_type = get_distance_type(distance_type)
+    queries = np.asarray(queries, dtype=np.float32)
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    products = queries @ embeddings.T
+    if distance_type == "cosine":
+        norms = np.linalg.norm(queries, axis=1)[:, None] * np.linalg.norm(
+            embeddings, axis=1
+        )
+        return 1 - products / np.maximum(norms, np.finfo(np.float32).tiny)
+
+    return (
+        (queries * queries).sum(axis=1)[:, None]
+        + (embeddings * embeddings).sum(axis=1)
+        - 2 * products
+    )
+
+
+def ground_truth(queries, embeddings, k=10, distance_type="l2sq", batch_size=None):
+    """
+    Returns the (queries, k) matrix of the indices of the exact k nearest
+    embeddings of every query, nearest first.
+
+    Queries are processed in batches to bound the size of the distance matrix.
+    """
+    k = min(k, len(embeddings))
+    if batch_size is None:
+        # about 256MB of intermediate values per batch
+        row_size = len(embeddings) * 8
+        batch_size = max(1, 2**28 // row_size)
+
+    results = []
+    for start in range(0, len(queries), batch_size):
+        distances = exact_distances(
+            queries[start : start + batch_size], embeddings, distance_type
+        )
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        order = np.argsort(np.take_along_axis(distances, nearest, axis=1), axis=1)
+        results.append(np.take_along_axis(nearest, order, axis=1))
+    return np.concatenate(results)
+
+
+def recall_at_k(results, truth, k=10):
+    """
+    Mean share of the exact k nearest neighbors found in the first k results
+    of every query.
+    """
+    found = 0
+    for result, expected in zip(results, truth):
+        found += len(set(result[:k]) & set(expected[:k]))
+    return found / (len(truth) * k) if len(truth) > 0 else 0.0
+
+
+def latency_summary(latencies):
+    latencies = np.asarray(latencies, dtype=np.float64)
+    total = latencies.sum()
+    return dotdict(
+        {
+            "queries": len(latencies),
+            "qps": len(latencies) / total if total > 0 else 0.0,
+            "mean": float(latencies.mean()),
+            "p50": float(np.percentile(latencies, 50)),
+            "p95": float(np.percentile(latencies, 95)),
+            "p99": float(np.percentile(latencies, 99)),
+        }
+    )
+
+
+def get_sweep(m=[12], ef_construction=[64], ef=[64]):
+    """Returns every combination of the given index parameters."""
+    return [
+        dotdict({"m": m_, "ef_construction": ef_construction_, "ef": ef_})
+        for m_, ef_construction_, ef_ in itertools.product(m, ef_construction, ef)
+    ]
+
+
+def _get_extension_version(client):
+    with client.connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT extversion FROM pg_extension WHERE extname = 'lantern'")
+            row = cur.fetchone()
+            return None if row is None else row[0]
+
+
+def run_benchmark(
+    url: str,
+    dataset: dict,
+    sweep: Optional[List[dict]] = None,
+    k: int = 10,
+    distance_type: str = "l2sq",
+    table_name: str = "lantern_benchmark",
+    warmup: int = 10,
+    chunk_size: int = 10000,
+    progress=None,
+):
+    """
+    Runs the benchmark and returns its results.
+
+    The embeddings are loaded once with `bulk_insert`, with their row index
+    as id. For every configuration of `sweep` (dicts with `m`,
+    `ef_construction` and `ef`) the index is rebuilt, then every query is
+    searched once after `warmup` untimed searches. The table is dropped at
+    the end.
+
+    Args:
+        url (str): Database URL.
+        dataset (dict): `embeddings` and `queries` arrays, and optionally a
+            precomputed `ground_truth`.
+        sweep (list, optional): Index configurations, see `get_sweep`.
+        k (int): Number of neighbors searched and compared.
+        distance_type (str): "l2sq" or "cosine".
+        table_name (str): Table the dataset is loaded into, it is dropped first.
+        warmup (int): Number of untimed searches before every configuration.
+        chunk_size (int): Number of rows per COPY chunk.
+        progress (callable, optional): Called with a message at every step.
+
+    Returns:
+        dotdict: The benchmark parameters and a `results` list with the
+        `recall`, `qps`, latency percentiles and `build_seconds` of every
+        configuration.
+    """
+    check_distance_type(distance_type)
+    sweep = sweep or get_sweep()
+    log = progress or (lambda message: None)
+    embeddings = np.asarray(dataset["embeddings"])
+    queries = np.asarray(dataset["queries"])
+    num_rows, dimensions = embeddings.shape
+
+    truth = dataset.get("ground_truth")
+    if truth is None:
+        log("computing ground truth")
+        truth = ground_truth(queries, embeddings, k, distance_type)
+
+    client = SyncClient(
+        url=url,
+        table_name=table_name,
+        dimensions=dimensions,
+        distance_type=distance_type,
+        max_db_connections=1,
+    )
+    try:
+        client.drop()
+        client.create_table()
+
+        log(f"loading {num_rows} rows")
+        start = time.perf_counter()
+        client.bulk_insert(
+            ((str(i), embedding.tolist()) for i, embedding in enumerate(embeddings)),
+            chunk_size=chunk_size,
+        )
+        load_seconds = time.perf_counter() - start
+
+        results = []
+        for config in sweep:
+            log(
+                f"building index m={config['m']} ef_construction={config['ef_construction']} ef={config['ef']}"
+            )
+            index = HNSWIndex(
+                dim=dimensions,
+                m=config["m"],
+                ef_construction=config["ef_construction"],
+                ef_search=config["ef"],
+            )
+            start = time.perf_counter()
+            with client.connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(client.builder.drop_embedding_index_query())
+                    cur.execute(client.builder.create_embedding_index_query(index))
+            build_seconds = time.perf_counter() - start
+
+            for query in queries[:warmup]:
+                client.search(query_embedding=query, limit=k, select_fields=["id"])
+
+            latencies = []
+            found = []
+            for query in queries:
+                start = time.perf_counter()
+                rows = client.search(
+                    query_embedding=query, limit=k, select_fields=["id"]
+                )
+                latencies.append(time.perf_counter() - start)
+                found.append([int(row.id) for row in rows])
+
+            result = dotdict(dict(config))
+            result.build_seconds = build_seconds
+            result.recall = recall_at_k(found, truth, k)
+            result.update(latency_summary(latencies))
+            log(
+                f"recall@{k}={result.recall:.4f} qps={result.qps:.1f} p99={result.p99 * 1000:.2f}ms"
+            )
+            results.append(result)
+
+        return dotdict(
+            {
+                "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "lantern": _get_extension_version(client),
+                "distance_type": distance_type,
+                "rows": num_rows,
+                "dimensions": dimensions,
+                "queries": len(queries),
+                "k": k,
+                "load_seconds": load_seconds,
+                "results": results,
+            }
+        )
+    finally:
+        try:
+            client.drop()
+        finally:
+            client.close()
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m lantern.benchmark",
+        description="Measure recall@k, QPS and latency of lantern HNSW indexes.",
+    )
+    parser.add_argument("--url", required=True, help="database URL")
+    parser.add_argument("--dataset", help=".npz file with embeddings and queries")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--dimensions", type=int, default=128)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--distance", default="l2sq", choices=["l2sq", "cosine"])
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--m", type=_int_list, default=[12])
+    parser.add_argument("--ef-construction", type=_int_list, default=[64])
+    parser.add_argument("--ef", type=_int_list, default=[64])
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--table", default="lantern_benchmark")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    if args.dataset is not None:
+        dataset = load_dataset(args.dataset)
+    else:
+        dataset = generate_dataset(
+            args.rows, args.dimensions, args.queries, args.distance, args.seed
+        )
+
+    results = run_benchmark(
+        args.url,
+        dataset,
+        get_sweep(args.m, args.ef_construction, args.ef),
+        k=args.k,
+        distance_type=args.distance,
+        table_name=args.table,
+        warmup=args.warmup,
+        progress=lambda message: print(message, file=sys.stderr),
+    )
+
+    output = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
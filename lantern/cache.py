@@ -0,0 +1,175 @@
+import hashlib
+import json
+import sys
+import threading
+import time
+import numpy as np
+from collections import OrderedDict
+from typing import Optional
+from .utils import dotdict
+
+
+def get_search_cache_key(
+    table_name,
+    generation,
+    query_embedding=None,
+    query_id=None,
+    limit=10,
+    filter=None,
+    select_fields=[],
+    output="dotdict",
+    ef=None,
+    init_k=None,
+    filter_strategy=None,
+):
+    """
+    Builds the cache key of a search, the embedding is hashed from its
+    float32 bytes so equal vectors match regardless of their python type.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    if query_embedding is not None:
+        digest.update(np.asarray(query_embedding, dtype=np.float32).tobytes())
+    digest.update(
+        json.dumps(
+            [
+                query_id,
+                limit,
+                filter,
+                list(select_fields),
+                output,
+                ef,
+                init_k,
+                filter_strategy,
+            ],
+            sort_keys=True,
+            default=str,
+        ).encode("utf-8")
+    )
+    return (table_name, generation, digest.hexdigest())
+
+
+def estimate_size(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(map(estimate_size, value))
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            estimate_size(k) + estimate_size(v) for k, v in value.items()
+        )
+    return sys.getsizeof(value)
+
+
+class SearchCache:
+    """
+    Thread-safe LRU cache for search results with a TTL and a memory bound.
+
+    Entries are keyed by table and table generation. Writes through a client
+    bump the generation of its table, which drops the cached results of that
+    table and prevents searches which started before the write from storing
+    stale results. A cache may be shared by several clients.
+
+    Cached results are returned as is and must not be mutated by the caller.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: Optional[float] = 60.0,
+        max_bytes: Optional[int] = 64 * 1024 * 1024,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def generation(self, table_name):
+        with self._lock:
+            return self._generations.get(table_name, 0)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, size, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = estimate_size(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            # the table was written to while the result was being computed
+            if key[1] != self._generations.get(key[0], 0):
+                return
+
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, expires_at)
+            self._bytes += size
+
+            while len(self._entries) > self.max_entries or (
+                self.max_bytes is not None and self._bytes > self.max_bytes
+            ):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, table_name=None):
+        """
+        Drops the cached results of a table, or of all tables when no
+        table name is given.
+        """
+        with self._lock:
+            self.invalidations += 1
+            tables = (
+                set(key[0] for key in self._entries) | set(self._generations)
+                if table_name is None
+                else [table_name]
+            )
+            for table in tables:
+                self._generations[table] = self._generations.get(table, 0) + 1
+
+            for key in [key for key in self._entries if key[0] in tables]:
+                self._remove(key)
+
+    def clear(self):
+        self.invalidate()
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        with self._lock:
+            return dotdict(
+                {
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "expirations": self.expirations,
+                    "invalidations": self.invalidations,
+                    "entries": len(self._entries),
+                    "bytes": self._bytes,
+                }
+            )
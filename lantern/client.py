@@ -1,16 +1,71 @@
 import json
+import functools
+import math
+import hashlib
+import itertools
+import threading
+import time
 import numpy as np
 import psycopg2.pool
-from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty, Full
 from typing import List, Optional, Union, Dict, Tuple, Any
 from psycopg2.extras import execute_values
-from contextlib import contextmanager
+from contextlib import contextmanager, ExitStack
+from .cache import SearchCache, get_search_cache_key
+from .filters import (
+    FilterUsage,
+    check_filter_strategy,
+    compile_filter,
+    get_metadata_expression,
+)
+from .pool import ConnectionPool
+from .quantization import (
+    binarize,
+    check_quantization,
+    get_binary_words,
+    get_copy_bits,
+)
+from .partitions import (
+    check_partitions,
+    get_copy_partition_values,
+    get_partition_value,
+    get_row_partition_value,
+    merge_results,
+)
+from .instrumentation import (
+    Instrumentation,
+    OperationEvent,
+    CountingReader,
+    instrumented,
+    current_event,
+    mark_event,
+    annotate_event,
+    running_event,
+)
 from .utils import (
     get_vector_result,
+    get_output_result,
+    check_output_type,
     prepare_insert_data,
-    default_max_db_connections,
+    get_unique_rows,
+    get_copy_chunks,
+    get_copy_line,
+    get_update_copy_line,
+    format_copy_chunk,
+    chunks,
+    dotdict,
+    get_binary_copy_payload,
+    CopyStream,
     get_select_fields,
     translate_to_pyformat,
+    to_array_literal,
+    get_session_settings_query,
+    forget_session_settings,
+    get_prepared_query,
+    max_prepared_statements,
+    register_numpy_embeddings,
+    to_vector_param,
 )
 
 
@@ -76,12 +131,35 @@ class QueryBuilder:
         num_dimensions: int,
         id_type: str,
         distance_type: str,
+        text_field: Optional[str] = None,
+        text_search_config: str = "english",
+        quantization: Optional[str] = None,
+        oversampling: int = 4,
+        partition_key: Optional[str] = None,
+        partition_by: str = "hash",
+        partitions: Union[int, List[str]] = 8,
     ) -> None:
+        check_quantization(quantization)
+        if partition_key is not None:
+            check_partitions(partition_by, partitions)
         self.table_name = table_name
         self.num_dimensions = num_dimensions
         self.distance_type = self._parse_distance_type(distance_type)
         self.distance_operator = self._get_distance_operator()
         self.id_type = id_type.lower()
+        # metadata key of the text indexed for full-text search, if any
+        self.text_field = text_field
+        self.text_search_config = text_search_config
+        # compact copy of the embeddings the HNSW index is built on, the
+        # `oversampling` times more candidates it returns are reranked exactly
+        self.quantization = quantization
+        self.oversampling = oversampling
+        if quantization is not None and self.distance_type == "hamming":
+            raise (Exception("Hamming embeddings can not be quantized"))
+        # metadata key whose value, stored in `partition_value`, partitions the table
+        self.partition_key = partition_key
+        self.partition_by = partition_by
+        self.partitions = partitions
 
     def row_exists_query(self):
         return "SELECT 1 FROM {table_name} LIMIT 1".format(
@@ -104,7 +182,7 @@ class QueryBuilder:
         elif self.distance_type == "cosine":
             return "<=>"
         elif self.distance_type == "hamming":
-            return "<#>"
+            return "<+>"
 
     def _get_distance_function(self, a, b):
         if self.distance_type == "euclidean":
@@ -118,37 +196,275 @@ class QueryBuilder:
     def _quote_ident(ident):
         return '"{}"'.format(ident.replace('"', '""'))
 
-    def get_upsert_query(self):
-        return "INSERT INTO {table_name} (id, embedding, metadata) VALUES %s ON CONFLICT DO NOTHING".format(
-            table_name=self._quote_ident(self.table_name)
+    def _get_upsert_conflict_clause(self, update=False):
+        if not update:
+            return "ON CONFLICT DO NOTHING"
+
+        bits = ""
+        if self.quantization is not None:
+            bits = ", embedding_bits = EXCLUDED.embedding_bits"
+
+        # rows whose embedding and metadata are unchanged are left untouched
+        return """ON CONFLICT ({key}) DO UPDATE SET embedding = EXCLUDED.embedding, metadata = EXCLUDED.metadata{bits}
+        WHERE {table_name}.embedding IS DISTINCT FROM EXCLUDED.embedding OR {table_name}.metadata IS DISTINCT FROM EXCLUDED.metadata""".format(
+            key="id" if self.partition_key is None else "id, partition_value",
+            table_name=self._quote_ident(self.table_name),
+            bits=bits,
+        )
+
+    def _get_derived_column_names(self):
+        # columns computed from the embedding and the metadata by the client,
+        # they always come last, after the given columns
+        columns = []
+        if self.quantization is not None:
+            columns.append("embedding_bits")
+        if self.partition_key is not None:
+            columns.append("partition_value")
+        return columns
+
+    def _get_derived_columns(self):
+        return "".join(", " + column for column in self._get_derived_column_names())
+
+    def get_upsert_query(self, values="%s", update=False):
+        return "INSERT INTO {table_name} (id, embedding, metadata{bits}) VALUES {values} {conflict}".format(
+            table_name=self._quote_ident(self.table_name),
+            bits=self._get_derived_columns(),
+            values=values,
+            conflict=self._get_upsert_conflict_clause(update),
+        )
+
+    def get_copy_query(self, binary=False, table_name=None):
+        return "COPY {table_name} (id, metadata, embedding{bits}) FROM STDIN{format}".format(
+            table_name=self._quote_ident(table_name or self.table_name),
+            bits=self._get_derived_columns(),
+            format=" (FORMAT BINARY)" if binary else "",
+        )
+
+    def _get_staging_table_name(self):
+        return self.table_name + "_staging"
+
+    def create_staging_table_query(self):
+        return "CREATE TEMP TABLE {staging_table} (LIKE {table_name} INCLUDING DEFAULTS) ON COMMIT DROP;".format(
+            staging_table=self._quote_ident(self._get_staging_table_name()),
+            table_name=self._quote_ident(self.table_name),
+        )
+
+    def _get_update_staging_table_name(self):
+        return self.table_name + "_updates"
+
+    def _get_id_column_type(self):
+        return {"serial": "integer", "bigserial": "bigint"}.get(
+            self.id_type, self.id_type
         )
 
+    def create_update_staging_table_query(self):
+        id_type = self._get_id_column_type()
+        return "CREATE TEMP TABLE {staging_table} (id {id_type}, metadata JSONB, embedding REAL[]{bits}) ON COMMIT DROP;".format(
+            staging_table=self._quote_ident(self._get_update_staging_table_name()),
+            id_type=id_type,
+            bits=(", embedding_bits INTEGER[]" if self.quantization is not None else "")
+            + (", partition_value TEXT" if self.partition_key is not None else ""),
+        )
+
+    def update_from_staging_table_query(self, merge_metadata=False):
+        if merge_metadata:
+            # only objects can be merged, anything else is replaced
+            metadata = "CASE WHEN jsonb_typeof(t.metadata) = 'object' AND jsonb_typeof(s.metadata) = 'object' THEN t.metadata || s.metadata ELSE s.metadata END"
+        else:
+            metadata = "s.metadata"
+
+        # NULL embedding or metadata in the staging table keeps the current value,
+        # when an id is staged more than once the last copied row wins
+        return """
+        UPDATE {table_name} AS t SET
+            embedding = COALESCE(s.embedding, t.embedding),
+            metadata = COALESCE({metadata}, t.metadata){set_bits}
+        FROM (
+            SELECT DISTINCT ON (id) id, embedding, metadata{bits} FROM {staging_table} ORDER BY id, ctid DESC
+        ) s
+        WHERE t.id = s.id
+        """.format(
+            table_name=self._quote_ident(self.table_name),
+            staging_table=self._quote_ident(self._get_update_staging_table_name()),
+            metadata=metadata,
+            bits=self._get_derived_columns(),
+            set_bits="".join(
+                ",\n            {column} = COALESCE(s.{column}, t.{column})".format(
+                    column=column
+                )
+                for column in self._get_derived_column_names()
+            ),
+        )
+
+    def merge_staging_table_query(self):
+        # when an id is staged more than once, the last copied row wins
+        return """
+        INSERT INTO {table_name} (id, embedding, metadata{bits})
+        SELECT DISTINCT ON (id) id, embedding, metadata{bits} FROM {staging_table} ORDER BY id, ctid DESC
+        {conflict}
+        """.format(
+            table_name=self._quote_ident(self.table_name),
+            bits=self._get_derived_columns(),
+            staging_table=self._quote_ident(self._get_staging_table_name()),
+            conflict=self._get_upsert_conflict_clause(update=True),
+        )
+
+    def _move_rows_query(self, source):
+        # the primary key of a partitioned table only makes an id unique within
+        # a partition value, rows written with a new value are moved first, an
+        # UPDATE of the partition column moves the row to its new partition
+        return "UPDATE {table_name} AS t SET partition_value = s.partition_value FROM {source} WHERE t.id = s.id AND t.partition_value <> s.partition_value".format(
+            table_name=self._quote_ident(self.table_name),
+            source=source,
+        )
+
+    def move_rows_query(self, ids, partition_values) -> Tuple[str, List]:
+        query = self._move_rows_query(
+            "unnest($1::{id_type}[], $2::text[]) AS s(id, partition_value)".format(
+                id_type=self._get_id_column_type()
+            )
+        )
+        return (query, [ids, partition_values])
+
+    def move_staged_rows_query(self):
+        return self._move_rows_query(
+            "(SELECT DISTINCT ON (id) id, partition_value FROM {staging_table} ORDER BY id, ctid DESC) AS s".format(
+                staging_table=self._quote_ident(self._get_staging_table_name())
+            )
+        )
+
+    def existing_ids_query(self, ids) -> Tuple[str, List]:
+        # 1-based positions of the given ids that are in the table, in any partition
+        query = "SELECT s.i FROM unnest($1::{id_type}[]) WITH ORDINALITY AS s(id, i) WHERE EXISTS (SELECT 1 FROM {table_name} AS t WHERE t.id = s.id)".format(
+            table_name=self._quote_ident(self.table_name),
+            id_type=self._get_id_column_type(),
+        )
+        return (query, [ids])
+
     def get_count_query(self):
         return "SELECT COUNT(*) as cnt FROM {table_name}".format(
             table_name=self._quote_ident(self.table_name)
         )
 
     def get_create_query(self):
+        bits_column = ""
+        if self.quantization is not None:
+            bits_column = ",\n                    embedding_bits INTEGER[{words}] NOT NULL".format(
+                words=get_binary_words(self.num_dimensions)
+            )
+        text_column = ""
+        text_index = ""
+        if self.text_field is not None:
+            text_column = ",\n                    tsv tsvector GENERATED ALWAYS AS ({document}) STORED".format(
+                document=self._get_text_document()
+            )
+            text_index = "CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} USING GIN(tsv);".format(
+                index_name=self._quote_ident(self.table_name + "_tsv_idx"),
+                table_name=self._quote_ident(self.table_name),
+            )
+
+        primary_key = " PRIMARY KEY"
+        partition_column = ""
+        partition_clause = ""
+        partition_tables = ""
+        if self.partition_key is not None:
+            # unique keys of a partitioned table must hold the partition column
+            primary_key = ""
+            partition_column = ",\n                    partition_value TEXT NOT NULL,\n                    PRIMARY KEY (id, partition_value)"
+            partition_clause = " PARTITION BY {method} (partition_value)".format(
+                method=self.partition_by.upper()
+            )
+            partition_tables = "\n                ".join(
+                "CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {table_name} {bounds};".format(
+                    partition=self._quote_ident(partition),
+                    table_name=self._quote_ident(self.table_name),
+                    bounds=bounds,
+                )
+                for partition, bounds in self._get_partition_bounds()
+            )
+
         return """
                 CREATE EXTENSION IF NOT EXISTS lantern;
                 CREATE TABLE IF NOT EXISTS {table_name} (
-                    id {id_type} PRIMARY KEY,
+                    id {id_type}{primary_key},
                     metadata JSONB NOT NULL DEFAULT '{{}}'::jsonb,
-                    embedding REAL[{dimensions}] NOT NULL
-                );
-                
+                    embedding REAL[{dimensions}] NOT NULL{bits_column}{text_column}{partition_column}
+                ){partition_clause};
+                {partition_tables}
+                {text_index}
         """.format(
             table_name=self._quote_ident(self.table_name),
             id_type=self.id_type,
+            primary_key=primary_key,
             dimensions=self.num_dimensions,
+            bits_column=bits_column,
+            text_column=text_column,
+            partition_column=partition_column,
+            partition_clause=partition_clause,
+            partition_tables=partition_tables,
+            text_index=text_index,
+        )
+
+    def _get_partition_bounds(self):
+        if self.partition_by == "hash":
+            return [
+                (
+                    f"{self.table_name}_p{i}",
+                    f"FOR VALUES WITH (MODULUS {self.partitions}, REMAINDER {i})",
+                )
+                for i in range(self.partitions)
+            ]
+
+        # rows of any other value go to the default partition
+        bounds = [
+            (
+                f"{self.table_name}_p{i}",
+                "FOR VALUES IN ('{}')".format(str(value).replace("'", "''")),
+            )
+            for i, value in enumerate(self.partitions)
+        ]
+        return bounds + [(f"{self.table_name}_default", "DEFAULT")]
+
+    def get_partition_names(self):
+        if self.partition_key is None:
+            return []
+        return [partition for partition, _ in self._get_partition_bounds()]
+
+    def get_partition_values(self, filter):
+        """
+        Returns the partition values a filter restricts the rows to, from an
+        equality or `$in` on the partition key, or None.
+        """
+        if self.partition_key is None or not isinstance(filter, dict):
+            return None
+        if self.partition_key not in filter:
+            return None
+
+        value = filter[self.partition_key]
+        if isinstance(value, dict):
+            if "$eq" in value:
+                value = value["$eq"]
+            elif "$in" in value and isinstance(value["$in"], (list, tuple)):
+                return [get_partition_value({"v": v}, "v") for v in value["$in"]]
+            else:
+                return None
+        return [get_partition_value({"v": value}, "v")]
+
+    def _get_text_search_config(self):
+        return "'{}'::regconfig".format(self.text_search_config.replace("'", "''"))
+
+    def _get_text_document(self):
+        return "to_tsvector({config}, coalesce({text}, ''))".format(
+            config=self._get_text_search_config(),
+            text=get_metadata_expression(self.text_field),
         )
 
-    def _get_embedding_index_name(self):
-        return self._quote_ident(self.table_name + "_embedding_idx")
+    def _get_embedding_index_name(self, table_name=None):
+        return self._quote_ident((table_name or self.table_name) + "_embedding_idx")
 
-    def drop_embedding_index_query(self):
+    def drop_embedding_index_query(self, table_name=None):
         return "DROP INDEX IF EXISTS {index_name};".format(
-            index_name=self._get_embedding_index_name()
+            index_name=self._get_embedding_index_name(table_name)
         )
 
     def delete_all_query(self):
@@ -171,7 +487,7 @@ class QueryBuilder:
         return (query, [ids])
 
     def get_by_id_query(self, select) -> str:
-        query = "SELECT {select_fields} FROM {table_name} WHERE id = %s;".format(
+        query = "SELECT {select_fields} FROM {table_name} WHERE id = $1;".format(
             table_name=self._quote_ident(self.table_name), select_fields=select
         )
         return query
@@ -182,7 +498,7 @@ class QueryBuilder:
         params: List[Any] = []
         (where, params) = self._where_clause_for_metadata(params, filter)
         query = "DELETE FROM {table_name} WHERE {where};".format(
-            table_name=self._quote_ident(self.table_name), where=where
+            table_name=self._quote_ident(self.table_name), where=" AND ".join(where)
         )
         return (query, params)
 
@@ -191,14 +507,27 @@ class QueryBuilder:
             table_name=self._quote_ident(self.table_name)
         )
 
-    def create_embedding_index_query(self, index: HNSWIndex) -> str:
+    def create_embedding_index_query(
+        self, index: HNSWIndex, table_name: Optional[str] = None
+    ) -> str:
         column_name = "embedding"
-        index_name = self._get_embedding_index_name()
+        distance_type = self.distance_type
+        if self.quantization is not None:
+            # the index holds only the sign bits, a fraction of the embeddings
+            column_name = "embedding_bits"
+            distance_type = "hamming"
+            index = HNSWIndex(
+                dim=get_binary_words(self.num_dimensions),
+                m=index.m,
+                ef_construction=index.ef_construction,
+                ef_search=index.ef_search,
+            )
+        index_name = self._get_embedding_index_name(table_name)
         return index.create_index_query(
-            self._quote_ident(self.table_name),
+            self._quote_ident(table_name or self.table_name),
             self._quote_ident(column_name),
             index_name,
-            self.distance_type,
+            distance_type,
         )
 
     def create_metadata_index_query(self):
@@ -207,73 +536,57 @@ class QueryBuilder:
             index_name=self._quote_ident(self.table_name + "_meta_idx"),
         )
 
+    def _get_metadata_expression_index_name(self, key, value_kind):
+        name = f"{self.table_name}_meta_{key}_{value_kind}_idx"
+        if len(name.encode("utf-8")) > 63:
+            digest = hashlib.md5(f"{self.table_name}/{key}".encode("utf-8")).hexdigest()
+            name = f"{self.table_name[:24]}_meta_{digest[:12]}_{value_kind}_idx"
+        return name
+
+    def create_metadata_expression_index_query(self, key, value_kind="text"):
+        """
+        Creates a B-tree index on the expression range filters on `key`
+        compare, without blocking writes to the table.
+        """
+        return "CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name} ON {table_name} (({expression}));".format(
+            index_name=self._quote_ident(
+                self._get_metadata_expression_index_name(key, value_kind)
+            ),
+            table_name=self._quote_ident(self.table_name),
+            expression=get_metadata_expression(key, value_kind),
+        )
+
     def _where_clause_for_metadata(
         self, params: List, filter: Dict[str, Union[str, Dict[str, str]]]
     ):
-        has_predicate = False
-        where_condition = []
-        where_params = params
-        predicates = {
-            "$eq": "=",
-            "$neq": "!=",
-            "$lt": "<",
-            "$lte": "<=",
-            "$gt": ">",
-            "$gte": ">=",
-            "$in": "IN",
-            "$nin": "NOT IN",
-        }
+        where, filter_params = compile_filter(filter, len(params))
+        params = list(params) + filter_params
+        where = [where]
 
-        for key, val in filter.items():
-            if type(val) is dict:
-                has_predicate = True
-                for pred_key, pred_val in val.items():
-                    predicate = predicates.get(pred_key)
-                    if not predicate:
-                        raise Exception(f"Invalid predicate {pred_key}")
-                    col_type = "TEXT"
-
-                    if type(pred_val) is int:
-                        col_type = "INT"
-                    elif type(pred_val) is float:
-                        col_type = "FLOAT"
-
-                    where_condition.append(
-                        "(metadata->>'{key}')::{col_type} {predicate} (${idx})".format(
-                            key=key,
-                            col_type=col_type,
-                            predicate=predicate,
-                            idx=len(where_params) + 1,
-                        )
-                    )
-                    where_params += [pred_val]
-            else:
-                where_condition.append(
-                    "(metadata->>{key}) = (${idx})".format(
-                        key=key, idx=len(where_params) + 1
-                    )
-                )
-                where_params += [val]
-
-        if not has_predicate:
-            where = "metadata @> ${index}".format(index=len(params) + 1)
-            json_object = json.dumps(filter)
-            return [where], params + [json_object]
-        else:
-            return where_condition, where_params
+        # a condition on the partition column prunes the other partitions
+        partition_values = self.get_partition_values(filter)
+        if partition_values is not None:
+            where.append(f"partition_value = ANY(${len(params) + 1}::text[])")
+            params.append(partition_values)
+        return where, params
 
     def get_update_by_id_query(self, embedding=None, metadata=None):
         query = "UPDATE {table_name} SET ".format(
             table_name=self._quote_ident(self.table_name)
         )
-        if embedding is not None and metadata is not None:
-            query += "embedding=$2, metadata=$3 "
-        elif metadata is not None:
-            query += "metadata=$2 "
-        elif embedding is not None:
-            query += "embedding=$2 "
-
-        query += "WHERE id=$1"
+        columns = []
+        if embedding is not None:
+            columns.append("embedding")
+        if metadata is not None:
+            columns.append("metadata")
+        # the derived columns of the new values follow, in the same order
+        if embedding is not None and self.quantization is not None:
+            columns.append("embedding_bits")
+        if metadata is not None and self.partition_key is not None:
+            columns.append("partition_value")
+
+        query += ", ".join(f"{column}=${i + 2}" for i, column in enumerate(columns))
+        query += " WHERE id=$1"
 
         return query
 
@@ -283,27 +596,63 @@ class QueryBuilder:
         limit: int = 10,
         filter: Optional[Dict[str, Union[str, Dict[str, str]]]] = None,
         select: List[str] = [],
+        query_id: Optional[Any] = None,
+        exact: bool = False,
+        candidates: Optional[int] = None,
+        table_name: Optional[str] = None,
     ) -> Tuple[str, List]:
+        """
+        Builds a kNN search. With `exact` the rows are ordered by the
+        distance function, which the HNSW index can not serve, so the
+        filtered rows are scanned and sorted exactly.
+
+        On quantized tables the index returns the `candidates` nearest rows
+        by the hamming distance of their sign bits, `oversampling * limit`
+        by default, and those are reranked by their exact distance.
+
+        `table_name` searches a single partition, the `query_id` row is
+        still looked up in the whole table.
+        """
 
         select_fields = get_select_fields(select)
         params: List[Any] = []
         distance_query = ""
-        if query_embedding is not None:
-            distance = "embedding {op} ${index}".format(
-                op=self.distance_operator, index=len(params) + 1
-            )
-            distance_query = self._get_distance_function(
-                "embedding", f"${len(params)+1}"
+        with_clause = ""
+        where_clauses = []
+        quantized = self.quantization is not None and not exact
+        if query_embedding is not None or query_id is not None:
+            if query_embedding is not None:
+                query_vector = "${index}::{type}".format(
+                    index=len(params) + 1, type=self._get_embedding_type()
+                )
+                params = params + [query_embedding]
+                if quantized:
+                    query_bits = "${index}::integer[]".format(index=len(params) + 1)
+                    params = params + [binarize(query_embedding)[0].tolist()]
+            else:
+                # the query vector is resolved on the server and never sent
+                # to the client, the CTE is evaluated once as an init plan
+                with_clause = "WITH query_vector AS (SELECT embedding{bits} FROM {table_name} WHERE id = ${index})".format(
+                    bits=", embedding_bits" if quantized else "",
+                    table_name=self._quote_ident(self.table_name),
+                    index=len(params) + 1,
+                )
+                query_vector = "(SELECT embedding FROM query_vector)"
+                query_bits = "(SELECT embedding_bits FROM query_vector)"
+                where_clauses.append(f"{query_vector} IS NOT NULL")
+                params = params + [query_id]
+
+            distance = "embedding {op} {query_vector}".format(
+                op=self.distance_operator, query_vector=query_vector
             )
-            params = params + [query_embedding]
+            distance_query = self._get_distance_function("embedding", query_vector)
             order_by_clause = "ORDER BY {distance} ASC".format(
-                distance=distance)
+                distance=distance_query if exact else distance)
         else:
             distance = "-1.0"
             distance_query = distance
             order_by_clause = ""
 
-        where_clauses = []
         if filter is not None:
             (where_filter, params) = self._where_clause_for_metadata(params, filter)
             where_clauses += where_filter
@@ -313,7 +662,35 @@ class QueryBuilder:
         else:
             where = "TRUE"
 
+        if quantized and order_by_clause != "":
+            query = """
+        {with_clause}
+        SELECT * FROM (
+            SELECT
+                {select_fields}, {distance_query} as distance
+            FROM
+               {table_name}
+            WHERE
+               {where}
+            ORDER BY embedding_bits <+> {query_bits} ASC
+            LIMIT {candidates}
+        ) candidates
+        ORDER BY distance ASC
+        LIMIT {limit}
+        """.format(
+                with_clause=with_clause,
+                select_fields=select_fields,
+                distance_query=distance_query,
+                table_name=self._quote_ident(table_name or self.table_name),
+                where=where,
+                query_bits=query_bits,
+                candidates=int(candidates or limit * self.oversampling),
+                limit=limit,
+            )
+            return (query, params)
+
         query = """
+        {with_clause}
         SELECT
             {select_fields}, {distance_query} as distance
         FROM
@@ -323,38 +700,308 @@ class QueryBuilder:
         {order_by_clause}
         LIMIT {limit}
         """.format(
+            with_clause=with_clause,
             select_fields=select_fields,
             distance=distance,
             order_by_clause=order_by_clause,
             where=where,
-            table_name=self._quote_ident(self.table_name),
+            table_name=self._quote_ident(table_name or self.table_name),
             limit=limit,
             distance_query=distance_query,
         )
         return (query, params)
 
+    def explain_filter_query(self, filter=None) -> Tuple[str, List]:
+        """Plans a scan of the rows matching `filter`, or of all rows."""
+        params: List[Any] = []
+        where = "TRUE"
+        if filter is not None:
+            (where_filter, params) = self._where_clause_for_metadata(params, filter)
+            where = " AND ".join(where_filter)
+        query = "EXPLAIN (FORMAT JSON) SELECT 1 FROM {table_name} WHERE {where}".format(
+            table_name=self._quote_ident(self.table_name), where=where
+        )
+        return (query, params)
+
+    def sample_filter_query(self, filter, percent) -> Tuple[str, List]:
+        """Counts the sampled rows and the sampled rows matching `filter`."""
+        (where_filter, params) = self._where_clause_for_metadata([percent], filter)
+        query = "SELECT count(*) FILTER (WHERE {where}), count(*) FROM {table_name} TABLESAMPLE SYSTEM ($1)".format(
+            table_name=self._quote_ident(self.table_name),
+            where=" AND ".join(where_filter),
+        )
+        return (query, params)
+
+    def _get_embedding_type(self):
+        if self.distance_type == "hamming":
+            return "integer[]"
+        return "real[]"
+
+    def search_many_query(
+        self,
+        query_embeddings: List[Union[List[float], np.ndarray]],
+        limit: int = 10,
+        filter: Optional[Dict[str, Union[str, Dict[str, str]]]] = None,
+        select: List[str] = [],
+        exact: bool = False,
+        candidates: Optional[int] = None,
+    ) -> Tuple[str, List]:
+        """
+        Builds a single statement running one kNN subquery per query embedding.
+
+        The embeddings are unnested with their ordinal and each one drives a
+        LATERAL subquery, so the HNSW index is used once per query. Rows are
+        returned as `(ord, *select_fields, distance)` ordered by input position.
+        `exact` and `candidates` are as in `search_query`.
+        """
+        select_fields = get_select_fields(select)
+        params: List[Any] = [list(map(to_array_literal, query_embeddings))]
+        query_vector = "q.query::{type}".format(type=self._get_embedding_type())
+        distance = "embedding {op} {query_vector}".format(
+            op=self.distance_operator, query_vector=query_vector
+        )
+        distance_query = self._get_distance_function("embedding", query_vector)
+        unnest = "unnest($1::text[]) WITH ORDINALITY AS q(query, ord)"
+        if exact:
+            distance = distance_query
+        elif self.quantization is not None:
+            params.append(list(map(to_array_literal, binarize(query_embeddings).tolist())))
+            unnest = "unnest($1::text[], $2::text[]) WITH ORDINALITY AS q(query, bits, ord)"
+
+        where_clauses = []
+        if filter is not None:
+            (where_filter, params) = self._where_clause_for_metadata(params, filter)
+            where_clauses += where_filter
+
+        if len(where_clauses) > 0:
+            where = " AND ".join(where_clauses)
+        else:
+            where = "TRUE"
+
+        if self.quantization is not None and not exact:
+            # the nearest candidates by sign bits are reranked exactly
+            lateral = """
+                SELECT * FROM (
+                    SELECT
+                        {select_fields}, {distance_query} as distance
+                    FROM
+                        {table_name}
+                    WHERE
+                        {where}
+                    ORDER BY embedding_bits <+> q.bits::integer[] ASC
+                    LIMIT {candidates}
+                ) candidates
+                ORDER BY distance ASC
+                LIMIT {limit}"""
+        else:
+            lateral = """
+                SELECT
+                    {select_fields}, {distance_query} as distance
+                FROM
+                    {table_name}
+                WHERE
+                    {where}
+                ORDER BY {distance} ASC
+                LIMIT {limit}"""
+
+        query = """
+        SELECT
+            q.ord, r.*
+        FROM
+            {unnest},
+            LATERAL ({lateral}
+            ) r
+        ORDER BY q.ord, r.distance
+        """.format(
+            unnest=unnest,
+            lateral=lateral.format(
+                select_fields=select_fields,
+                distance=distance,
+                where=where,
+                table_name=self._quote_ident(self.table_name),
+                limit=limit,
+                candidates=int(candidates or limit * self.oversampling),
+                distance_query=distance_query,
+            ),
+        )
+        return (query, params)
+
+    def hybrid_search_query(
+        self,
+        query_embedding: Union[List[float], np.ndarray],
+        query_text: str,
+        limit: int = 10,
+        filter: Optional[Dict[str, Union[str, Dict[str, str]]]] = None,
+        select: List[str] = [],
+        candidates: Optional[int] = None,
+        fusion: str = "rrf",
+        rrf_k: int = 60,
+        vector_weight: float = 1.0,
+        text_weight: float = 1.0,
+    ) -> Tuple[str, List]:
+        """
+        Builds a single statement fusing a kNN search and a full-text search.
+
+        The `candidates` nearest rows and the `candidates` best text matches
+        are ranked in two CTEs and joined on id. With "rrf" fusion a row
+        scores `weight / (rrf_k + rank)` in each list it appears in, with
+        "weighted" fusion the min-max normalized similarity and the text rank
+        normalized by the best one are weighted and added. Rows are returned
+        as `(*select_fields, score)`, best first.
+        """
+        if self.text_field is None:
+            raise (Exception("Hybrid search needs a table created with a text_field"))
+        if fusion not in ("rrf", "weighted"):
+            raise (Exception(f"Invalid fusion {fusion}, expected rrf or weighted"))
+
+        candidates = max(candidates or 4 * limit, limit)
+        select_fields = get_select_fields(select)
+        params: List[Any] = [
+            query_embedding,
+            query_text,
+            float(vector_weight),
+            float(text_weight),
+            int(rrf_k),
+        ]
+        query_vector = "$1::{type}".format(type=self._get_embedding_type())
+        vector_order = "embedding {op} {query_vector}".format(
+            op=self.distance_operator, query_vector=query_vector
+        )
+        if self.quantization is not None:
+            vector_order = "embedding_bits <+> $6::integer[]"
+            params.append(binarize(query_embedding)[0].tolist())
+        where = "TRUE"
+        if filter is not None:
+            (where_filter, params) = self._where_clause_for_metadata(params, filter)
+            where = " AND ".join(where_filter)
+
+        if fusion == "rrf":
+            vector_score = "$3::float8 / ($5 + row_number() OVER (ORDER BY distance))"
+            text_score = "$4::float8 / ($5 + row_number() OVER (ORDER BY text_rank DESC))"
+        else:
+            vector_score = "$3::float8 * coalesce((max(distance) OVER () - distance) / nullif(max(distance) OVER () - min(distance) OVER (), 0), 1)"
+            text_score = "$4::float8 * coalesce(text_rank / nullif(max(text_rank) OVER (), 0), 1)"
+
+        query = """
+        WITH vector_hits AS (
+            SELECT * FROM (
+                SELECT id, {distance_query} AS distance
+                FROM {table_name}
+                WHERE {where}
+                ORDER BY {vector_order} ASC
+                LIMIT {vector_candidates}
+            ) vector_candidates
+            ORDER BY distance ASC
+            LIMIT {candidates}
+        ), text_hits AS (
+            SELECT id, ts_rank_cd(tsv, text_query) AS text_rank
+            FROM {table_name}, websearch_to_tsquery({config}, $2) AS text_query
+            WHERE tsv @@ text_query AND {where}
+            ORDER BY text_rank DESC
+            LIMIT {candidates}
+        ), fused AS (
+            SELECT coalesce(v.id, t.id) AS hybrid_id, coalesce(v.score, 0) + coalesce(t.score, 0) AS hybrid_score
+            FROM (SELECT id, {vector_score} AS score FROM vector_hits) v
+            FULL OUTER JOIN (SELECT id, {text_score} AS score FROM text_hits) t ON v.id = t.id
+        )
+        SELECT {select_fields}, hybrid_score
+        FROM fused JOIN {table_name} ON id = hybrid_id
+        ORDER BY hybrid_score DESC
+        LIMIT {limit}
+        """.format(
+            distance_query=self._get_distance_function("embedding", query_vector),
+            table_name=self._quote_ident(self.table_name),
+            where=where,
+            vector_order=vector_order,
+            vector_candidates=int(
+                candidates
+                if self.quantization is None
+                else candidates * self.oversampling
+            ),
+            candidates=int(candidates),
+            config=self._get_text_search_config(),
+            vector_score=vector_score,
+            text_score=text_score,
+            select_fields=select_fields,
+            limit=int(limit),
+        )
+        return (query, params)
+
+    def sample_embeddings_query(self):
+        return "SELECT embedding FROM {table_name} ORDER BY random() LIMIT $1".format(
+            table_name=self._quote_ident(self.table_name)
+        )
+
     def delete_table_query(self):
         return "DROP TABLE IF EXISTS {table_name} CASCADE".format(
             table_name=self._quote_ident(self.table_name)
         )
 
 
+def write_method(method):
+    """
+    Marks a client method as a write: it invalidates the cached search
+    results of the table and starts the read-your-writes window.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.last_write_at = time.monotonic()
+            if self.cache is not None:
+                self.cache.invalidate(self.table_name)
+
+    return wrapper
+
+
 class SyncClient:
     def __init__(
         self,
         table_name: str,
         dimensions: int,
         url: Optional[str] = None,
-        pool: Optional[psycopg2.pool.SimpleConnectionPool] = None,
+        pool: Optional[psycopg2.pool.AbstractConnectionPool] = None,
         distance_type: str = "cosine",
         max_db_connections: Optional[int] = None,
         id_type: str = "TEXT",
         m: Optional[int] = 12,
         ef: Optional[int] = 64,
         ef_construction: Optional[int] = 64,
+        prepare: bool = False,
+        max_prepared_statements: int = max_prepared_statements,
+        numpy_embeddings: bool = False,
+        cache: Optional[SearchCache] = None,
+        replica_urls: Optional[List[str]] = None,
+        read_your_writes: float = 0.0,
+        pool_options: Optional[Dict[str, Any]] = None,
+        instrumentation: Optional[Instrumentation] = None,
+        filter_usage: Optional[FilterUsage] = None,
+        filter_strategy: str = "index",
+        exact_search_rows: int = 10000,
+        max_init_k: int = 1000,
+        text_field: Optional[str] = None,
+        text_search_config: str = "english",
+        quantization: Optional[str] = None,
+        oversampling: int = 4,
+        partition_key: Optional[str] = None,
+        partition_by: str = "hash",
+        partitions: Union[int, List[str]] = 8,
     ) -> None:
+        check_filter_strategy(filter_strategy)
         self.builder = QueryBuilder(
-            table_name, dimensions, id_type, distance_type
+            table_name,
+            dimensions,
+            id_type,
+            distance_type,
+            text_field=text_field,
+            text_search_config=text_search_config,
+            quantization=quantization,
+            oversampling=oversampling,
+            partition_key=partition_key,
+            partition_by=partition_by,
+            partitions=partitions,
         )
         self.db_url = url
         self.pool = pool
@@ -364,25 +1011,152 @@ class SyncClient:
         self.m = m
         self.ef = ef
         self.ef_construction = ef_construction
+        self.prepare = prepare
+        self.max_prepared_statements = max_prepared_statements
+        self.numpy_embeddings = numpy_embeddings
+        self.cache = cache
+        self.replica_urls = replica_urls or []
+        self.replica_pools = [None] * len(self.replica_urls)
+        self.read_your_writes = read_your_writes
+        self.last_write_at = None
+        self.pool_options = pool_options or {}
+        self.instrumentation = instrumentation
+        self.filter_usage = filter_usage
+        # search-time ef, set by `tune_ef`, None uses the ef of the index
+        self.search_ef = None
+        self.filter_strategy = filter_strategy
+        self.exact_search_rows = exact_search_rows
+        self.max_init_k = max_init_k
+        self.selectivity_ttl = 60.0
+        # filter selectivity estimates as (estimate, expires_at)
+        self._selectivity = {}
+        self._selectivity_lock = threading.Lock()
+        self._next_replica = itertools.count()
+        self._pool_lock = threading.Lock()
+        # threads searching the partitions of a partitioned table in parallel
+        self._executor = None
+
+    def _create_pool(self, url):
+        # without max_db_connections the pool sizes itself on its first connection
+        return ConnectionPool(
+            1, self.max_db_connections, dsn=url, **self.pool_options
+        )
 
-    @contextmanager
-    def connect(self):
+    def _get_primary_pool(self):
         if self.pool == None:
-            if self.max_db_connections == None:
-                self.max_db_connections = default_max_db_connections(
-                    self.db_url)
-
-            self.pool = psycopg2.pool.SimpleConnectionPool(
-                1, self.max_db_connections, dsn=self.db_url
-            )
+            with self._pool_lock:
+                if self.pool == None:
+                    self.pool = self._create_pool(self.db_url)
+        return self.pool
+
+    def _get_read_pool(self):
+        if len(self.replica_urls) == 0:
+            return self._get_primary_pool()
+
+        # reads right after a write of this client see the primary
+        if (
+            self.last_write_at is not None
+            and time.monotonic() - self.last_write_at < self.read_your_writes
+        ):
+            return self._get_primary_pool()
+
+        idx = next(self._next_replica) % len(self.replica_urls)
+        if self.replica_pools[idx] is None:
+            with self._pool_lock:
+                if self.replica_pools[idx] is None:
+                    self.replica_pools[idx] = self._create_pool(
+                        self.replica_urls[idx]
+                    )
+        return self.replica_pools[idx]
 
-        connection = self.pool.getconn()
+    @contextmanager
+    def connect(self, read_only=False):
+        """
+        Checks a connection out of the pool and commits when the block exits.
+
+        Args:
+            read_only (bool): Route to a replica when replicas are configured.
+                Writes and DDL must use the primary.
+        """
+        self._mark("build")
+        pool = self._get_read_pool() if read_only else self._get_primary_pool()
+        connection = pool.getconn()
+        self._mark("checkout")
         try:
             yield connection
+            self._mark("execute")
             connection.commit()
+            self._mark("commit")
+        except:
+            # SETs and PREPAREs of the failed transaction are in an unknown state
+            forget_session_settings(connection)
+            raise
         finally:
-            self.pool.putconn(connection)
+            pool.putconn(connection)
+
+    def _search_settings(self, limit, ef=None, init_k=None):
+        ef = self.search_ef if ef is None else ef
+        if init_k is None:
+            # quantized indexes return candidates to rerank
+            init_k = limit
+            if self.builder.quantization is not None:
+                init_k = limit * self.builder.oversampling
+        return {
+            "lantern_hnsw.init_k": int(init_k),
+            "lantern_hnsw.ef": None if ef is None else int(ef),
+            "enable_seqscan": "off",
+        }
+
+    def _exact_search_settings(self):
+        # the filter indexes serve exact searches, or else a sequential scan
+        return {"enable_seqscan": "on"}
+
+    def _cursor(self, conn, output="dotdict"):
+        cur = conn.cursor()
+        if self.numpy_embeddings or output == "numpy":
+            register_numpy_embeddings(cur)
+        return cur
+
+    def _mark(self, phase, rows=0, bytes_sent=0):
+        if self.instrumentation is not None:
+            mark_event(phase, rows, bytes_sent)
 
+    def _annotate(self, **attributes):
+        if self.instrumentation is not None:
+            annotate_event(**attributes)
+
+    def _execute(self, conn, cur, query, params, settings=""):
+        if self.prepare:
+            query, params = get_prepared_query(
+                conn, cur, query, params, self.max_prepared_statements
+            )
+        else:
+            query, params = translate_to_pyformat(query, params)
+        if self.instrumentation is not None:
+            annotate_event(set_statements=settings.count(";"), prepared=self.prepare)
+            mark_event("settings")
+        cur.execute(settings + query, params)
+        if self.instrumentation is not None:
+            mark_event("execute", bytes_sent=len(cur.query or b""))
+
+    def _record_filter(self, filter, start):
+        if self.filter_usage is not None and filter:
+            self.filter_usage.record(
+                self.table_name, filter, time.monotonic() - start
+            )
+
+    def _fetchall(self, cur):
+        rows = cur.fetchall()
+        self._mark("fetch", rows=len(rows))
+        return rows
+
+    def _copy(self, cur, query, f):
+        if self.instrumentation is not None:
+            f = CountingReader(f, current_event())
+        cur.copy_expert(query, f)
+        self._mark("execute", rows=max(cur.rowcount, 0))
+
+    @instrumented
     def exists(self):
         with self.connect() as conn:
             with conn.cursor() as cur:
@@ -394,15 +1168,24 @@ class SyncClient:
                     return False
 
     def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
         if self.pool != None:
             self.pool.closeall()
+        for pool in self.replica_pools:
+            if pool is not None:
+                pool.closeall()
 
+    @instrumented
+    @write_method
     def create_table(self):
         query = self.builder.get_create_query()
         with self.connect() as conn:
             with conn.cursor() as cur:
                 cur.execute(query)
 
+    @instrumented
+    @write_method
     def create_index(self):
         hnsw_index = HNSWIndex(
             dim=self.dimensions,
@@ -410,61 +1193,387 @@ class SyncClient:
             ef_construction=self.ef_construction,
             ef_search=self.ef,
         )
-        hnsw_query = self.builder.create_embedding_index_query(hnsw_index)
         meta_query = self.builder.create_metadata_index_query()
+        if self.builder.partition_key is not None:
+            with self.connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(meta_query)
+            self.reindex_partitions()
+            return
+
+        hnsw_query = self.builder.create_embedding_index_query(hnsw_index)
         with self.connect() as conn:
             with conn.cursor() as cur:
                 cur.execute(hnsw_query)
                 cur.execute(meta_query)
 
-    def upsert(self, data):
+    @instrumented
+    @write_method
+    def reindex_partitions(self, partitions=None, num_connections=4):
+        """
+        Rebuilds the HNSW index of every partition, or of the given ones,
+        `num_connections` partitions at a time. Each partition is rebuilt in
+        its own transaction, so the other partitions stay searchable.
+
+        Returns:
+            list: The rebuilt partitions.
+        """
+        if self.builder.partition_key is None:
+            raise (Exception("The table is not partitioned"))
+
+        partitions = partitions or self.builder.get_partition_names()
+        hnsw_index = HNSWIndex(
+            dim=self.dimensions,
+            m=self.m,
+            ef_construction=self.ef_construction,
+            ef_search=self.ef,
+        )
+
+        def reindex(partition):
+            with self.connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(self.builder.drop_embedding_index_query(partition))
+                    cur.execute(
+                        self.builder.create_embedding_index_query(
+                            hnsw_index, table_name=partition
+                        )
+                    )
+            return partition
+
+        with ThreadPoolExecutor(max_workers=num_connections) as executor:
+            return list(executor.map(reindex, partitions))
+
+    def _with_derived(self, values):
+        # appends the derived columns to prepared (id, embedding, metadata) values
+        if self.builder.quantization is not None:
+            bits = binarize([value[1] for value in values]).tolist()
+            values = [value + (row_bits,) for value, row_bits in zip(values, bits)]
+        if self.builder.partition_key is not None:
+            values = [
+                value
+                + (get_row_partition_value(value[2], self.builder.partition_key),)
+                for value in values
+            ]
+        return values
+
+    def _get_format_chunk(self, update=False, merge_metadata=False):
+        extra_columns = []
+        if self.builder.quantization is not None:
+            extra_columns.append(get_copy_bits)
+        if self.builder.partition_key is not None:
+            extra_columns.append(
+                functools.partial(
+                    get_copy_partition_values,
+                    key=self.builder.partition_key,
+                    update=update,
+                    merge_metadata=merge_metadata,
+                )
+            )
+        if len(extra_columns) == 0:
+            return format_copy_chunk
+        return functools.partial(format_copy_chunk, extra_columns=extra_columns)
+
+    def _copy_chunks(
+        self, rows, chunk_size, progress, format_line=get_copy_line, format_chunk=None
+    ):
+        return get_copy_chunks(
+            rows,
+            chunk_size,
+            progress,
+            format_line,
+            format_chunk or self._get_format_chunk(),
+        )
+
+    @instrumented
+    @write_method
+    def upsert(self, data, update=False):
         if data is None or len(data) == 0:
             raise (Exception("Data can not be empty"))
 
-        query = self.builder.get_upsert_query()
+        query = self.builder.get_upsert_query(update=update)
 
-        values = prepare_insert_data(data)
+        values = self._with_derived([prepare_insert_data(data)])
 
         with self.connect() as conn:
             with conn.cursor() as cur:
-                return execute_values(cur, query, (values,))
+                if self.builder.partition_key is not None:
+                    values = self._unique_partition_rows(cur, values, update)
+                    if len(values) == 0:
+                        return
+                return execute_values(cur, query, values)
 
-    def upsert_many(self, data):
+    @instrumented
+    @write_method
+    def upsert_many(self, data, update=False):
         if data is None or len(data) == 0:
             raise (Exception("Data can not be empty"))
 
-        query = self.builder.get_upsert_query()
+        query = self.builder.get_upsert_query(update=update)
 
-        values = list(map(prepare_insert_data, data))
+        # an id may only be inserted or updated once per statement, the last
+        # row of an id wins an update and the first one an insert
+        values = get_unique_rows(list(map(prepare_insert_data, data)), last=update)
+        values = self._with_derived(values)
 
         with self.connect() as conn:
             with conn.cursor() as cur:
+                if self.builder.partition_key is not None:
+                    values = self._unique_partition_rows(cur, values, update)
+                    if len(values) == 0:
+                        return
                 return execute_values(cur, query, values)
 
-    def bulk_insert(self, rows):
-        f = StringIO("")
-        rows_len = len(rows)
-        for i in range(len(rows)):
-            data = prepare_insert_data(rows[i])
-
-            id = data[0]
-            embedding = data[1]
-            metadata = data[2]
-
-            metadata = metadata.replace("\\", "\\\\").replace('"', '\\"')
-            f.write(f"{id}\t{metadata}\t{{{str(embedding)[1:-1]}}}")
-            if i != rows_len - 1:
-                f.write("\n")
-        f.seek(0)
+    def _unique_partition_rows(self, cur, values, update):
+        """
+        Keeps ids unique across the partitions of the table before upserting
+        `values`. An update moves the existing rows of the ids to the partition
+        of their new value, an insert drops the rows whose id already exists.
+        The ids of `values` must be unique, see `get_unique_rows`.
+        """
+        ids = [value[0] for value in values]
+
+        if update:
+            query, params = self.builder.move_rows_query(
+                ids, [value[-1] for value in values]
+            )
+            query, params = translate_to_pyformat(query, params)
+            cur.execute(query, params)
+            return values
+
+        query, params = self.builder.existing_ids_query(ids)
+        query, params = translate_to_pyformat(query, params)
+        cur.execute(query, params)
+        existing = set(row[0] for row in cur.fetchall())
+        return [value for i, value in enumerate(values, 1) if i not in existing]
+
+    @instrumented
+    @write_method
+    def bulk_insert(self, rows, chunk_size=10000, progress=None):
+        """
+        Streams rows into the table with `COPY ... FROM STDIN`.
+
+        Args:
+            rows (iterable): `(id, embedding, metadata)` rows. Any iterable or
+                generator is accepted, it is consumed `chunk_size` rows at a time
+                so memory stays flat regardless of the input size.
+            chunk_size (int): Number of rows formatted and sent per chunk.
+            progress (callable, optional): Called as `progress(rows, rows_per_second)`
+                after each chunk is sent.
+        """
+        f = CopyStream(self._copy_chunks(rows, chunk_size, progress))
         with self.connect() as conn:
             with conn.cursor() as cur:
-                cur.copy_expert(
-                    "COPY {table_name} (id, metadata, embedding) FROM STDIN".format(
-                        table_name=QueryBuilder._quote_ident(self.table_name)
+                self._copy(cur, self.builder.get_copy_query(), f)
+
+    @instrumented
+    @write_method
+    def bulk_upsert(self, rows, chunk_size=10000, progress=None):
+        """
+        Inserts new rows and updates existing ones in a single merge.
+
+        Rows are streamed with COPY into a temporary staging table, which is
+        then merged with one `INSERT ... SELECT ... ON CONFLICT (id) DO UPDATE`.
+        Rows whose embedding and metadata did not change are skipped, so they
+        produce no WAL and no index churn. Both the embedding and the metadata
+        of an existing row are replaced. On a partitioned table, existing rows
+        whose partition key changed are moved to their new partition first.
+
+        Args:
+            rows (iterable): `(id, embedding, metadata)` rows.
+            chunk_size (int): Number of rows formatted and sent per chunk.
+            progress (callable, optional): Called as `progress(rows, rows_per_second)`
+                after each chunk is copied into the staging table.
+
+        Returns:
+            int: Number of rows inserted or updated.
+        """
+        f = CopyStream(self._copy_chunks(rows, chunk_size, progress))
+        with self.connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute(self.builder.create_staging_table_query())
+                self._copy(
+                    cur,
+                    self.builder.get_copy_query(
+                        table_name=self.builder._get_staging_table_name()
                     ),
                     f,
                 )
+                if self.builder.partition_key is not None:
+                    cur.execute(self.builder.move_staged_rows_query())
+                cur.execute(self.builder.merge_staging_table_query())
+                return cur.rowcount
+
+    @instrumented
+    @write_method
+    def parallel_bulk_insert(
+        self, rows, num_connections=4, chunk_size=10000, progress=None
+    ):
+        """
+        Splits a stream of rows across `num_connections` pooled connections,
+        each running its own `COPY ... FROM STDIN` into the table.
+
+        Rows are read from the input `chunk_size` at a time and handed to the
+        first idle connection, so the input may be a generator of any size.
+        The connections commit one after the other, only after every COPY
+        has finished. If a COPY fails, the others are aborted and nothing is
+        committed. The commits are not atomic though: if one of them fails,
+        the streams committed before it stay loaded, so a failed load may
+        leave part of the rows in the table.
+
+        Args:
+            rows (iterable): `(id, embedding, metadata)` rows.
+            num_connections (int): Number of concurrent COPY streams. The pool
+                must allow at least this many connections.
+            chunk_size (int): Number of rows per chunk.
+            progress (callable, optional): Called as `progress(rows, rows_per_second)`
+                with the aggregated totals after each chunk. It is invoked from
+                the worker threads.
+
+        Returns:
+            dotdict: `rows`, `seconds` and `rows_per_second` totals, plus
+            `connections` with the `rows` and `seconds` of every stream.
+        """
+        query = self.builder.get_copy_query()
+        format_chunk = self._get_format_chunk()
+        queue = Queue(maxsize=num_connections * 2)
+        stop = threading.Event()
+        lock = threading.Lock()
+        errors = []
+        totals = dotdict({"rows": 0})
+        stats = [
+            dotdict({"rows": 0, "seconds": 0.0}) for _ in range(num_connections)
+        ]
+        start = time.monotonic()
+
+        def get_chunk():
+            while True:
+                try:
+                    return queue.get(timeout=0.1)
+                except Empty:
+                    if stop.is_set():
+                        raise (Exception("Parallel bulk insert aborted"))
+
+        def put_chunk(chunk):
+            while not stop.is_set():
+                try:
+                    queue.put(chunk, timeout=0.1)
+                    return
+                except Full:
+                    continue
+
+        def copy_chunks(stat):
+            while True:
+                chunk = get_chunk()
+                if chunk is None:
+                    return
+                if stop.is_set():
+                    raise (Exception("Parallel bulk insert aborted"))
+
+                yield format_chunk(chunk)
+                stat.rows += len(chunk)
+                if progress is not None:
+                    with lock:
+                        totals.rows += len(chunk)
+                        elapsed = time.monotonic() - start
+                        progress(totals.rows, totals.rows / elapsed if elapsed > 0 else 0.0)
+
+        def worker(conn, stat):
+            worker_start = time.monotonic()
+            try:
+                with conn.cursor() as cur:
+                    cur.copy_expert(query, CopyStream(copy_chunks(stat)))
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                stat.seconds = time.monotonic() - worker_start
+
+        # connections are checked out here, from a single thread, and
+        # committed together once all streams are done
+        with ExitStack() as stack:
+            connections = [
+                stack.enter_context(self.connect()) for _ in range(num_connections)
+            ]
+            threads = [
+                threading.Thread(target=worker, args=(conn, stat))
+                for conn, stat in zip(connections, stats)
+            ]
+            for thread in threads:
+                thread.start()
+
+            try:
+                for chunk in chunks(rows, chunk_size):
+                    if stop.is_set():
+                        break
+                    put_chunk(chunk)
+                for _ in threads:
+                    put_chunk(None)
+            except BaseException:
+                stop.set()
+                raise
+            finally:
+                for thread in threads:
+                    thread.join()
+
+            if len(errors) > 0:
+                raise errors[0]
+            self._mark("execute", rows=sum(stat.rows for stat in stats))
+
+        seconds = time.monotonic() - start
+        total_rows = sum(stat.rows for stat in stats)
+        return dotdict(
+            {
+                "rows": total_rows,
+                "seconds": seconds,
+                "rows_per_second": total_rows / seconds if seconds > 0 else 0.0,
+                "connections": stats,
+            }
+        )
+
+    @instrumented
+    @write_method
+    def bulk_insert_binary(self, ids, embeddings, metadata=None):
+        """
+        Loads a batch with `COPY ... (FORMAT BINARY)`, writing the REAL[]
+        values straight from the embedding matrix buffer instead of
+        formatting every float as text.
+
+        Args:
+            ids (list): Row ids, one per embedding row.
+            embeddings (np.ndarray): (n, dimensions) float32 matrix.
+            metadata (list, optional): Per-row metadata.
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.ndim != 2 or embeddings.shape[1] != self.dimensions:
+            raise (
+                Exception(
+                    f"Embeddings must have shape (n, {self.dimensions}), got {embeddings.shape}"
+                )
+            )
+
+        bits = None
+        if self.builder.quantization is not None:
+            bits = binarize(embeddings)
+        partition_values = None
+        if self.builder.partition_key is not None:
+            partition_values = [
+                get_row_partition_value(meta, self.builder.partition_key)
+                for meta in (metadata or [None] * len(ids))
+            ]
+        f = get_binary_copy_payload(
+            ids,
+            embeddings,
+            metadata,
+            id_type=self.builder.id_type,
+            bits=bits,
+            partition_values=partition_values,
+        )
+        with self.connect() as conn:
+            with conn.cursor() as cur:
+                self._copy(cur, self.builder.get_copy_query(binary=True), f)
 
+    @instrumented
+    @write_method
     def update_by_id(self, id, embedding=None, metadata=None):
         query = self.builder.get_update_by_id_query(embedding, metadata)
         with self.connect() as conn:
@@ -473,11 +1582,65 @@ class SyncClient:
                     metadata = json.dumps(metadata)
 
                 params = tuple(
-                    filter(lambda x: x is not None, [id, embedding, metadata])
+                    filter(
+                        lambda x: x is not None,
+                        [id, to_vector_param(embedding), metadata],
+                    )
                 )
+                if embedding is not None and self.builder.quantization is not None:
+                    params += (binarize(embedding)[0].tolist(),)
+                if metadata is not None and self.builder.partition_key is not None:
+                    params += (
+                        get_row_partition_value(metadata, self.builder.partition_key),
+                    )
                 query, params = translate_to_pyformat(query, params)
                 cur.execute(query, params)
 
+    @instrumented
+    @write_method
+    def update_many(self, rows, merge_metadata=False, chunk_size=10000, progress=None):
+        """
+        Updates many rows with one `UPDATE ... FROM` statement.
+
+        The rows are streamed with COPY into a temporary staging table which
+        is then applied in a single statement and transaction.
+
+        Args:
+            rows (iterable): `(id, embedding, metadata)` tuples. The embedding and
+                the metadata may be None or omitted to keep the current value.
+            merge_metadata (bool): Merge the given metadata into the current one
+                with `jsonb ||` instead of replacing it.
+            chunk_size (int): Number of rows formatted and sent per chunk.
+            progress (callable, optional): Called as `progress(rows, rows_per_second)`
+                after each chunk is copied into the staging table.
+
+        Returns:
+            int: Number of updated rows.
+        """
+        f = CopyStream(
+            self._copy_chunks(
+                rows,
+                chunk_size,
+                progress,
+                get_update_copy_line,
+                self._get_format_chunk(update=True, merge_metadata=merge_metadata),
+            )
+        )
+        with self.connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute(self.builder.create_update_staging_table_query())
+                self._copy(
+                    cur,
+                    self.builder.get_copy_query(
+                        table_name=self.builder._get_update_staging_table_name()
+                    ),
+                    f,
+                )
+                cur.execute(self.builder.update_from_staging_table_query(merge_metadata))
+                return cur.rowcount
+
+    @instrumented
+    @write_method
     def delete_by_ids(self, ids):
         query, params = self.builder.delete_by_ids_query(ids)
         query, params = translate_to_pyformat(query, params)
@@ -485,36 +1648,73 @@ class SyncClient:
             with conn.cursor() as cur:
                 cur.execute(query, params)
 
+    @instrumented
+    @write_method
+    def delete_by_metadata(self, filter):
+        """
+        Deletes the rows matching a metadata filter.
+
+        Returns:
+            int: Number of deleted rows.
+        """
+        start = time.monotonic()
+        query, params = self.builder.delete_by_metadata_query(filter)
+        query, params = translate_to_pyformat(query, params)
+        with self.connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, params)
+                deleted = cur.rowcount
+        self._record_filter(filter, start)
+        return deleted
+
+    @instrumented
+    @write_method
     def drop(self):
         query = self.builder.delete_table_query()
         with self.connect() as conn:
             with conn.cursor() as cur:
                 cur.execute(query)
 
+    @instrumented
     def get_by_id(self, id, select_fields=[]):
         query = self.builder.get_by_id_query(get_select_fields(select_fields))
-        with self.connect() as conn:
-            with conn.cursor() as cur:
-                cur.execute(query, id)
-                return get_vector_result(cur.fetchall(), select_fields, True)
-
-    def get_by_ids(self, ids=[], select_fields=[]):
+        params = id if isinstance(id, (list, tuple)) else [id]
+        with self.connect(read_only=True) as conn:
+            with self._cursor(conn) as cur:
+                self._execute(conn, cur, query, params)
+                rows = self._fetchall(cur)
+                result = get_vector_result(rows, select_fields, True)
+                self._mark("decode")
+                return result
+
+    @instrumented
+    def get_by_ids(self, ids=[], select_fields=[], output="dotdict"):
+        check_output_type(output)
         query, params = self.builder.get_by_ids_query(
             get_select_fields(select_fields), ids
         )
-        query, params = translate_to_pyformat(query, params)
-        with self.connect() as conn:
-            with conn.cursor() as cur:
-                cur.execute(query, params)
-                return get_vector_result(cur.fetchall(), select_fields)
+        with self.connect(read_only=True) as conn:
+            with self._cursor(conn, output) as cur:
+                self._execute(conn, cur, query, params)
+                result = get_output_result(
+                    self._fetchall(cur),
+                    select_fields,
+                    output,
+                    self.dimensions,
+                    with_distance=False,
+                )
+                self._mark("decode")
+                return result
 
+    @instrumented
     def count(self):
         query = self.builder.get_count_query()
-        with self.connect() as conn:
+        with self.connect(read_only=True) as conn:
             with conn.cursor() as cur:
                 cur.execute(query)
-                return cur.fetchall()[0][0]
+                return self._fetchall(cur)[0][0]
 
+    @instrumented
     def search(
         self,
         query_id: Optional[str] = None,
@@ -522,27 +1722,566 @@ class SyncClient:
         limit: Optional[int] = 10,
         filter: Optional[dict] = None,
         select_fields: Optional[List[str]] = [],
+        output: str = "dotdict",
+        ef: Optional[int] = None,
+        init_k: Optional[int] = None,
+        filter_strategy: Optional[str] = None,
     ):
-        if not query_id and not query_embedding:
+        """
+        Returns the `limit` nearest rows to `query_embedding`, or to the
+        embedding of the row `query_id`.
+
+        Args:
+            ef (int, optional): Search-time ef for this call, instead of
+                `search_ef` or the ef of the index.
+            init_k (int, optional): Number of candidates the index returns,
+                `limit` by default.
+            filter_strategy (str, optional): How a `filter` is applied,
+                instead of the `filter_strategy` of the client:
+                "index" filters the `init_k` candidates of the index and
+                "exact" scans the matching rows exactly. "adaptive" scans
+                exactly when at most `exact_search_rows` rows are estimated
+                to match, and otherwise raises `init_k` from the estimated
+                selectivity, then fourfold up to `max_init_k`, until
+                `limit` rows pass the filter.
+        """
+        check_output_type(output)
+        filter_strategy = filter_strategy or self.filter_strategy
+        check_filter_strategy(filter_strategy)
+        if filter is None:
+            filter_strategy = "index"
+        if not query_id and query_embedding is None:
             raise (
                 Exception(
                     "Please provide 'query_id' or 'query_embedding' argument for search"
                 )
             )
-        if query_id:
-            row = self.get_by_id([query_id], ["embedding"])
-            if row is None:
-                return []
-            else:
-                query_embedding = row.embedding
+        query_embedding = None if query_id else to_vector_param(query_embedding)
+        self._annotate(limit=limit, filtered=filter is not None, output=output)
+
+        if self.cache is not None:
+            cache_key = get_search_cache_key(
+                self.table_name,
+                self.cache.generation(self.table_name),
+                query_embedding,
+                query_id,
+                limit,
+                filter,
+                select_fields,
+                output,
+                self.search_ef if ef is None else ef,
+                init_k,
+                filter_strategy,
+            )
+            result = self.cache.get(cache_key)
+            self._annotate(cache_hit=result is not None)
+            if result is not None:
+                return result
+
+        start = time.monotonic()
+        search = (query_embedding, query_id or None, limit, filter, select_fields)
+        if filter_strategy == "adaptive":
+            rows = self._adaptive_search(search, output, ef, init_k)
+        elif filter_strategy == "exact":
+            rows = self._run_search(
+                search, output, self._exact_search_settings(), exact=True
+            )
+        else:
+            rows = self._run_search(
+                search, output, self._search_settings(limit, ef, init_k)
+            )
+        result = get_output_result(rows, select_fields, output, self.dimensions)
+        self._mark("decode")
+        self._record_filter(filter, start)
+
+        if self.cache is not None:
+            self.cache.put(cache_key, result)
+        return result
+
+    def _run_search(self, search, output, settings, exact=False, table_name=None):
+        query_embedding, query_id, limit, filter, select_fields = search
+        if (
+            table_name is None
+            and self.builder.partition_key is not None
+            and self.builder.get_partition_values(filter) is None
+        ):
+            return self._fan_out_search(search, output, settings, exact)
 
         query, params = self.builder.search_query(
-            query_embedding, limit=limit, filter=filter, select=select_fields
+            query_embedding,
+            limit=limit,
+            filter=filter,
+            select=select_fields,
+            query_id=query_id,
+            exact=exact,
+            candidates=settings.get("lantern_hnsw.init_k"),
+            table_name=table_name,
+        )
+        with self.connect(read_only=True) as conn:
+            with self._cursor(conn, output) as cur:
+                settings = get_session_settings_query(conn, settings)
+                self._execute(conn, cur, query, params, settings)
+                return self._fetchall(cur)
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._pool_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=len(self.builder.get_partition_names()),
+                        thread_name_prefix="lantern-partitions",
+                    )
+        return self._executor
+
+    def _fan_out_search(self, search, output, settings, exact=False):
+        """
+        Searches every partition on its own connection, in parallel, and
+        merges the nearest rows of all partitions.
+        """
+        partitions = self.builder.get_partition_names()
+        self._annotate(partitions=len(partitions))
+        parent = current_event() if self.instrumentation is not None else None
+
+        def search_partition(partition):
+            if parent is None:
+                return self._run_search(
+                    search, output, settings, exact, table_name=partition
+                )
+            # the worker thread marks its own event, added to the parent below
+            event = OperationEvent("partition", partition, parent)
+            with running_event(event):
+                rows = self._run_search(
+                    search, output, settings, exact, table_name=partition
+                )
+            return rows, event
+
+        results = list(self._get_executor().map(search_partition, partitions))
+        if parent is not None:
+            events = [event for _, event in results]
+            results = [rows for rows, _ in results]
+            # the partitions overlap in time, so the wait for all of them is
+            # reported as execute and their own phases as an attribute
+            self._mark(
+                "execute",
+                rows=sum(event.rows for event in events),
+                bytes_sent=sum(event.bytes_sent for event in events),
+            )
+            self._annotate(
+                partition_timings={
+                    event.table_name: dict(event.timings) for event in events
+                }
+            )
+        return merge_results(results, search[2])
+
+    def _adaptive_search(self, search, output, ef=None, init_k=None):
+        limit, filter = search[2], search[3]
+        estimate = self.estimate_filter_selectivity(filter)
+        self._annotate(selectivity=estimate.selectivity)
+        if estimate.matching_rows <= self.exact_search_rows:
+            self._annotate(filter_strategy="exact", attempts=0)
+            return self._run_search(
+                search, output, self._exact_search_settings(), exact=True
+            )
+
+        # enough candidates for `limit` of them to pass the filter on average
+        if init_k is None:
+            init_k = math.ceil(limit * 1.5 / max(estimate.selectivity, 1e-9))
+        init_k = max(limit, min(init_k, self.max_init_k))
+        attempts = 0
+        while True:
+            attempts += 1
+            rows = self._run_search(
+                search, output, self._search_settings(limit, ef, init_k)
+            )
+            if len(rows) >= limit or init_k >= self.max_init_k:
+                break
+            init_k = min(init_k * 4, self.max_init_k)
+
+        self._annotate(filter_strategy="adaptive", attempts=attempts, init_k=init_k)
+        if len(rows) < limit:
+            # the filter rejected even the largest candidate set
+            self._annotate(filter_strategy="exact")
+            rows = self._run_search(
+                search, output, self._exact_search_settings(), exact=True
+            )
+        return rows
+
+    @instrumented
+    def estimate_filter_selectivity(
+        self, filter: dict, method: str = "planner", sample_size: int = 1000
+    ):
+        """
+        Estimates the share of rows matching a metadata filter.
+
+        The "planner" method reads the row estimates of the query planner,
+        which cost no scan but only know the statistics of `ANALYZE`. The
+        "sample" method counts the matching rows of a `TABLESAMPLE` of about
+        `sample_size` rows. Estimates are cached for `selectivity_ttl`
+        seconds per filter.
+
+        Returns:
+            dotdict: The `selectivity`, and the estimated `matching_rows`
+            and `total_rows`.
+        """
+        if method not in ("planner", "sample"):
+            raise (Exception(f"Invalid method {method}, expected planner or sample"))
+        key = (method, sample_size, json.dumps(filter, sort_keys=True, default=str))
+        now = time.monotonic()
+        with self._selectivity_lock:
+            entry = self._selectivity.get(key)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+
+        with self.connect(read_only=True) as conn:
+            with conn.cursor() as cur:
+                total_rows = self._explain_rows(cur, None)
+                if method == "planner":
+                    matching_rows = self._explain_rows(cur, filter)
+                    selectivity = matching_rows / total_rows if total_rows > 0 else 0.0
+                else:
+                    percent = min(100.0, 100.0 * sample_size / max(total_rows, 1))
+                    query, params = translate_to_pyformat(
+                        *self.builder.sample_filter_query(filter, percent)
+                    )
+                    cur.execute(query, params)
+                    (matching, sampled) = cur.fetchone()
+                    selectivity = matching / sampled if sampled > 0 else 0.0
+                    matching_rows = selectivity * total_rows
+
+        estimate = dotdict(
+            {
+                "selectivity": min(selectivity, 1.0),
+                "matching_rows": matching_rows,
+                "total_rows": total_rows,
+            }
+        )
+        with self._selectivity_lock:
+            if len(self._selectivity) >= 1024:
+                self._selectivity.clear()
+            self._selectivity[key] = (estimate, now + self.selectivity_ttl)
+        return estimate
+
+    def _explain_rows(self, cur, filter):
+        query, params = translate_to_pyformat(
+            *self.builder.explain_filter_query(filter)
+        )
+        cur.execute(query, params)
+        plan = cur.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]["Plan"]["Plan Rows"]
+
+    @instrumented
+    def search_many(
+        self,
+        query_embeddings: List[List[Union[float, int]]],
+        limit: Optional[int] = 10,
+        filter: Optional[dict] = None,
+        select_fields: Optional[List[str]] = [],
+        output: str = "dotdict",
+        ef: Optional[int] = None,
+        init_k: Optional[int] = None,
+    ):
+        """
+        Runs several kNN searches in one statement and one round trip.
+
+        Args:
+            query_embeddings (list): Query vectors, a list of lists or a 2-d array.
+            limit (int): Number of results per query.
+            filter (dict, optional): Metadata filter applied to every query.
+            select_fields (list, optional): Columns to return.
+            output (str): "dotdict" for a list of rows, "numpy" for columnar arrays.
+            ef (int, optional): Search-time ef, as in `search`.
+            init_k (int, optional): Number of index candidates, as in `search`.
+
+        Returns:
+            list: One result per query embedding, in input order.
+        """
+        check_output_type(output)
+        if len(query_embeddings) == 0:
+            return []
+
+        start = time.monotonic()
+        search_settings = self._search_settings(limit, ef, init_k)
+        query, params = self.builder.search_many_query(
+            query_embeddings,
+            limit=limit,
+            filter=filter,
+            select=select_fields,
+            candidates=search_settings["lantern_hnsw.init_k"],
+        )
+        self._annotate(
+            queries=len(query_embeddings),
+            limit=limit,
+            filtered=filter is not None,
+            output=output,
+        )
+        results = [[] for _ in range(len(query_embeddings))]
+        with self.connect(read_only=True) as conn:
+            with self._cursor(conn, output) as cur:
+                settings = get_session_settings_query(conn, search_settings)
+                self._execute(conn, cur, query, params, settings)
+                for row in self._fetchall(cur):
+                    results[row[0] - 1].append(row[1:])
+        self._record_filter(filter, start)
+
+        results = [
+            get_output_result(rows, select_fields, output, self.dimensions)
+            for rows in results
+        ]
+        self._mark("decode")
+        return results
+
+    @instrumented
+    def hybrid_search(
+        self,
+        query_text: str,
+        query_embedding: List[Union[float, int]],
+        limit: int = 10,
+        filter: Optional[dict] = None,
+        select_fields: Optional[List[str]] = [],
+        output: str = "dotdict",
+        fusion: str = "rrf",
+        candidates: Optional[int] = None,
+        rrf_k: int = 60,
+        vector_weight: float = 1.0,
+        text_weight: float = 1.0,
+        ef: Optional[int] = None,
+    ):
+        """
+        Fuses a kNN search and a full-text search of the `text_field` in one
+        statement, the table must have been created with a `text_field`.
+
+        Args:
+            query_text (str): Text query, in web search syntax.
+            query_embedding (list): Query vector.
+            limit (int): Number of results.
+            filter (dict, optional): Metadata filter applied to both searches.
+            select_fields (list, optional): Columns to return.
+            output (str): "dotdict" for a list of rows, "numpy" for columnar arrays.
+            fusion (str): "rrf" for reciprocal rank fusion, "weighted" for
+                the weighted sum of the normalized scores.
+            candidates (int, optional): Number of rows each search ranks,
+                `4 * limit` by default.
+            rrf_k (int): Rank constant of reciprocal rank fusion.
+            vector_weight (float): Weight of the kNN search.
+            text_weight (float): Weight of the full-text search.
+            ef (int, optional): Search-time ef, as in `search`.
+
+        Returns:
+            The fused rows, best first, with a `score` instead of a
+            `distance`, or `scores` instead of `distances` with numpy output.
+        """
+        check_output_type(output)
+        start = time.monotonic()
+        candidates = max(candidates or 4 * limit, limit)
+        query, params = self.builder.hybrid_search_query(
+            to_vector_param(query_embedding),
+            query_text,
+            limit=limit,
+            filter=filter,
+            select=select_fields,
+            candidates=candidates,
+            fusion=fusion,
+            rrf_k=rrf_k,
+            vector_weight=vector_weight,
+            text_weight=text_weight,
+        )
+        self._annotate(limit=limit, fusion=fusion, filtered=filter is not None)
+        with self.connect(read_only=True) as conn:
+            with self._cursor(conn, output) as cur:
+                settings = get_session_settings_query(
+                    conn, self._search_settings(candidates, ef)
+                )
+                self._execute(conn, cur, query, params, settings)
+                result = get_output_result(
+                    self._fetchall(cur), select_fields, output, self.dimensions
+                )
+        self._record_filter(filter, start)
+
+        if output == "numpy":
+            result.scores = result.pop("distances")
+        else:
+            for row in result:
+                row.score = row.pop("distance")
+        self._mark("decode")
+        return result
+
+    def _exact_search_many(self, query_embeddings, limit, filter=None):
+        query, params = self.builder.search_many_query(
+            query_embeddings, limit=limit, filter=filter, select=["id"], exact=True
         )
         query, params = translate_to_pyformat(query, params)
+        results = [[] for _ in range(len(query_embeddings))]
+        with self.connect(read_only=True) as conn:
+            with conn.cursor() as cur:
+                # SET LOCAL ends with the transaction, so the settings
+                # tracked for the connection stay valid
+                cur.execute(
+                    "SET LOCAL enable_indexscan=off; SET LOCAL enable_seqscan=on; "
+                    + query,
+                    params,
+                )
+                for row in cur.fetchall():
+                    results[row[0] - 1].append(row[1])
+        return results
+
+    @instrumented
+    def tune_ef(
+        self,
+        target_recall: float = 0.95,
+        limit: int = 10,
+        query_embeddings=None,
+        sample_size: int = 100,
+        candidates: List[int] = [10, 16, 24, 32, 48, 64, 96, 128, 192, 256, 400],
+        filter: Optional[dict] = None,
+    ):
+        """
+        Finds the smallest search-time ef reaching a recall target and sets it
+        as `search_ef`, the default ef of this client's searches.
+
+        Every candidate ef is measured with `search_many` against the exact
+        results of a sequential scan, in increasing order until one reaches
+        `target_recall`. If none does, the largest candidate is used.
+
+        Args:
+            target_recall (float): Required mean recall@limit.
+            limit (int): Number of results per search.
+            query_embeddings (list, optional): Representative queries. By
+                default `sample_size` embeddings are sampled from the table.
+            sample_size (int): Number of sampled embeddings.
+            candidates (list): ef values to try.
+            filter (dict, optional): Metadata filter of the searches.
+
+        Returns:
+            dotdict: The chosen `ef`, its `recall`, and `trials` with the
+            `ef`, `recall` and `seconds` of every measured candidate.
+        """
+        if query_embeddings is None:
+            query, params = translate_to_pyformat(
+                self.builder.sample_embeddings_query(), [sample_size]
+            )
+            with self.connect(read_only=True) as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query, params)
+                    query_embeddings = [row[0] for row in cur.fetchall()]
+        if len(query_embeddings) == 0:
+            raise (Exception("Can not tune ef without query embeddings"))
+
+        exact = self._exact_search_many(query_embeddings, limit, filter)
+        trials = []
+        for ef in sorted(candidates):
+            start = time.monotonic()
+            results = self.search_many(
+                query_embeddings, limit, filter, ["id"], ef=ef
+            )
+            seconds = time.monotonic() - start
+
+            found = sum(
+                len(set(row.id for row in result) & set(expected))
+                for result, expected in zip(results, exact)
+            )
+            total = sum(len(expected) for expected in exact)
+            recall = found / total if total > 0 else 1.0
+            trials.append(dotdict({"ef": ef, "recall": recall, "seconds": seconds}))
+            if recall >= target_recall:
+                break
+
+        self.search_ef = trials[-1].ef
+        return dotdict(
+            {"ef": trials[-1].ef, "recall": trials[-1].recall, "trials": trials}
+        )
+
+    @instrumented
+    def advise_indexes(self, min_count: int = 1, create: bool = False):
+        """
+        Proposes B-tree expression indexes for the metadata keys compared
+        with `$lt`, `$lte`, `$gt` or `$gte` in the filters recorded by
+        `filter_usage`, which the GIN metadata index can not serve.
+
+        The usage of a key adds up that of all its operators, so a range
+        with both bounds counts twice.
+
+        Args:
+            min_count (int): Minimum number of recorded predicates per key.
+            create (bool): Create the missing indexes with
+                `CREATE INDEX CONCURRENTLY`, one at a time.
+
+        Returns:
+            list: One proposal per key and value kind, most total time first,
+            with its `query`, `index_name`, usage counters, whether the index
+            already `exists` and whether it was `created`.
+        """
+        if self.filter_usage is None:
+            raise (Exception("Filter usage is not recorded, pass filter_usage to the client"))
+
+        proposals = {}
+        for usage in self.filter_usage.stats(self.table_name):
+            if usage.value_kind is None:
+                continue
+            proposal = proposals.get((usage.key, usage.value_kind))
+            if proposal is None:
+                proposal = dotdict(
+                    {
+                        "key": usage.key,
+                        "value_kind": usage.value_kind,
+                        "operators": [],
+                        "count": 0,
+                        "total_seconds": 0.0,
+                        "index_name": self.builder._get_metadata_expression_index_name(
+                            usage.key, usage.value_kind
+                        ),
+                        "query": self.builder.create_metadata_expression_index_query(
+                            usage.key, usage.value_kind
+                        ),
+                        "exists": False,
+                        "created": False,
+                    }
+                )
+                proposals[(usage.key, usage.value_kind)] = proposal
+            proposal.operators.append(usage.operator)
+            proposal.count += usage.count
+            proposal.total_seconds += usage.total_seconds
+
+        proposals = sorted(
+            (p for p in proposals.values() if p.count >= min_count),
+            key=lambda p: p.total_seconds,
+            reverse=True,
+        )
+        if len(proposals) == 0:
+            return proposals
+
         with self.connect() as conn:
             with conn.cursor() as cur:
-                cur.execute(f"SET lantern_hnsw.init_k={limit}")
-                cur.execute("SET enable_seqscan=OFF")
-                cur.execute(query, params)
-                return get_vector_result(cur.fetchall(), select_fields)
+                for proposal in proposals:
+                    cur.execute(
+                        "SELECT to_regclass(%s) IS NOT NULL",
+                        (self.builder._quote_ident(proposal.index_name),),
+                    )
+                    proposal.exists = cur.fetchone()[0]
+
+        if create:
+            for proposal in proposals:
+                if not proposal.exists:
+                    self._create_index_concurrently(proposal.index_name, proposal.query)
+                    proposal.exists = proposal.created = True
+        return proposals
+
+    def _create_index_concurrently(self, index_name, query):
+        # CREATE INDEX CONCURRENTLY can not run inside a transaction block
+        with self.connect() as conn:
+            conn.autocommit = True
+            try:
+                with conn.cursor() as cur:
+                    try:
+                        cur.execute(query)
+                    except:
+                        # a failed concurrent build leaves an invalid index behind
+                        cur.execute(
+                            "DROP INDEX CONCURRENTLY IF EXISTS {index_name}".format(
+                                index_name=self.builder._quote_ident(index_name)
+                            )
+                        )
+                        raise
+            finally:
+                conn.autocommit = False
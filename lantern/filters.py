@@ -0,0 +1,251 @@
+import json
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+from .utils import dotdict
+
+range_operators = {"$lt": "<", "$lte": "<=", "$gt": ">", "$gte": ">="}
+
+filter_strategies = ("index", "adaptive", "exact")
+
+# SQL of every compiled filter shape and first parameter number
+compiled_filters = {}
+compiled_filters_lock = threading.Lock()
+max_compiled_filters = 4096
+
+
+def check_filter_strategy(filter_strategy):
+    if filter_strategy not in filter_strategies:
+        raise (
+            Exception(
+                f"Invalid filter strategy {filter_strategy}, expected one of {filter_strategies}"
+            )
+        )
+
+
+def _quote_literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _get_jsonpath(key):
+    return "$." + json.dumps(key)
+
+
+def _get_value_kind(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return "numeric"
+    return "text"
+
+
+def get_metadata_expression(key, value_kind="text"):
+    """
+    Returns the expression range filters compare, B-tree expression indexes
+    must be built on the same expression to serve them.
+    """
+    expression = f"(metadata->>{_quote_literal(key)})"
+    if value_kind == "numeric":
+        expression += "::numeric"
+    return expression
+
+
+def _analyze(filter, params):
+    """
+    Returns the shape of a filter, which holds everything but the values,
+    and appends its parameters to `params` in the order the SQL uses them.
+    """
+    if not isinstance(filter, dict):
+        raise Exception(f"Invalid filter {filter!r}, expected a dict")
+
+    containment = {}
+    parts = []
+    part_params = []
+    for key, value in filter.items():
+        if key in ("$and", "$or"):
+            if not isinstance(value, (list, tuple)):
+                raise Exception(f"{key} expects a list of filters")
+            sub_params = []
+            shapes = tuple(_analyze(sub_filter, sub_params) for sub_filter in value)
+            parts.append((key, shapes))
+            part_params += sub_params
+        elif key.startswith("$"):
+            raise Exception(f"Invalid predicate {key}")
+        elif isinstance(value, dict) and any(k.startswith("$") for k in value):
+            for op, op_value in value.items():
+                if op == "$eq":
+                    containment[key] = op_value
+                elif op in ("$ne", "$neq"):
+                    parts.append(("$ne",))
+                    part_params.append(json.dumps({key: op_value}))
+                elif op in ("$in", "$nin"):
+                    if not isinstance(op_value, (list, tuple)):
+                        op_value = [op_value]
+                    parts.append((op,))
+                    part_params.append([json.dumps({key: v}) for v in op_value])
+                elif op == "$exists":
+                    parts.append((op, bool(op_value)))
+                    part_params.append(_get_jsonpath(key))
+                elif op in range_operators:
+                    value_kind = _get_value_kind(op_value)
+                    if value_kind == "text" and not isinstance(op_value, str):
+                        op_value = json.dumps(op_value)
+                    parts.append((op, key, value_kind))
+                    part_params.append(op_value)
+                else:
+                    raise Exception(f"Invalid predicate {op}")
+        else:
+            containment[key] = value
+
+    # equality on any number of keys is a single containment test
+    if len(containment) > 0 or len(parts) == 0:
+        parts.insert(0, ("$contains",))
+        params.append(json.dumps(containment))
+    params += part_params
+    return ("$and", tuple(parts))
+
+
+def _compile(shape, params_count):
+    """Returns the SQL of a filter shape and the number of parameters used."""
+    kind = shape[0]
+    idx = params_count + 1
+
+    if kind in ("$and", "$or"):
+        if len(shape[1]) == 0:
+            return ("TRUE" if kind == "$and" else "FALSE"), params_count
+        conditions = []
+        for part in shape[1]:
+            condition, params_count = _compile(part, params_count)
+            conditions.append(condition)
+        if len(conditions) == 1:
+            return conditions[0], params_count
+        joiner = " AND " if kind == "$and" else " OR "
+        return "(" + joiner.join(conditions) + ")", params_count
+    if kind == "$contains":
+        return f"metadata @> ${idx}::jsonb", idx
+    if kind == "$ne":
+        return f"NOT (metadata @> ${idx}::jsonb)", idx
+    if kind == "$in":
+        return f"metadata @> ANY(${idx}::jsonb[])", idx
+    if kind == "$nin":
+        return f"NOT (metadata @> ANY(${idx}::jsonb[]))", idx
+    if kind == "$exists":
+        condition = f"metadata @? ${idx}::jsonpath"
+        return (condition if shape[1] else f"NOT ({condition})"), idx
+
+    _, key, value_kind = shape
+    return (
+        f"{get_metadata_expression(key, value_kind)} {range_operators[kind]} ${idx}",
+        idx,
+    )
+
+
+def compile_filter(filter: Dict[str, Any], params_count: int = 0) -> Tuple[str, List]:
+    """
+    Compiles a metadata filter to a SQL condition and its parameters.
+
+    Plain values and `$eq` are merged into a single `metadata @> $n`
+    containment test, and `$ne`, `$in` and `$nin` are containment tests as
+    well (`@> ANY($n::jsonb[])` for lists), so all of them can use the
+    `jsonb_path_ops` GIN index. `$exists` is a `@?` jsonpath test. The range
+    operators `$lt`, `$lte`, `$gt` and `$gte` compare `metadata->>'key'`,
+    cast to numeric for numbers, which B-tree expression indexes can serve.
+    Conditions are combined with `$and` and `$or` lists of filters, and
+    the keys of a filter are implicitly and-ed.
+
+    The SQL depends only on the shape of the filter, its keys and operators,
+    and is cached per shape, so repeated searches send identical statements.
+
+    Args:
+        filter (dict): The metadata filter.
+        params_count (int): Number of parameters the query already uses,
+            the filter parameters are numbered after them.
+
+    Returns:
+        tuple: The SQL condition and its parameters.
+    """
+    params = []
+    shape = _analyze(filter, params)
+    key = (shape, params_count)
+    with compiled_filters_lock:
+        sql = compiled_filters.get(key)
+    if sql is None:
+        sql, _ = _compile(shape, params_count)
+        with compiled_filters_lock:
+            if len(compiled_filters) >= max_compiled_filters:
+                compiled_filters.clear()
+            compiled_filters[key] = sql
+    return sql, params
+
+
+def get_filter_predicates(filter):
+    """
+    Returns the set of `(key, operator, value_kind)` predicates of a filter,
+    plain values are reported as `$eq`.
+    """
+    predicates = set()
+    for key, value in filter.items():
+        if key in ("$and", "$or"):
+            for sub_filter in value:
+                predicates |= get_filter_predicates(sub_filter)
+        elif isinstance(value, dict) and any(k.startswith("$") for k in value):
+            for op, op_value in value.items():
+                op = "$ne" if op == "$neq" else op
+                kind = _get_value_kind(op_value) if op in range_operators else None
+                predicates.add((key, op, kind))
+        else:
+            predicates.add((key, "$eq", None))
+    return predicates
+
+
+class FilterUsage:
+    """
+    Thread-safe record of the metadata predicates used in filters, with the
+    number of queries and their observed latency, per table. A record may be
+    shared by several clients.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._predicates = {}
+
+    def record(self, table_name, filter, seconds):
+        if not filter:
+            return
+        predicates = get_filter_predicates(filter)
+        with self._lock:
+            for key, op, kind in predicates:
+                usage = self._predicates.get((table_name, key, op, kind))
+                if usage is None:
+                    usage = [0, 0.0, 0.0]
+                    self._predicates[(table_name, key, op, kind)] = usage
+                usage[0] += 1
+                usage[1] += seconds
+                usage[2] = max(usage[2], seconds)
+
+    def stats(self, table_name: Optional[str] = None):
+        """
+        Returns the recorded predicates, most total time first, each with
+        its `count`, `total_seconds`, `mean_seconds` and `max_seconds`.
+        """
+        with self._lock:
+            items = list(self._predicates.items())
+
+        stats = [
+            dotdict(
+                {
+                    "table_name": table,
+                    "key": key,
+                    "operator": op,
+                    "value_kind": kind,
+                    "count": count,
+                    "total_seconds": total,
+                    "mean_seconds": total / count,
+                    "max_seconds": max_seconds,
+                }
+            )
+            for (table, key, op, kind), (count, total, max_seconds) in items
+            if table_name is None or table == table_name
+        ]
+        return sorted(stats, key=lambda s: s.total_seconds, reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self._predicates.clear()
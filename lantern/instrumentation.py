@@ -0,0 +1,236 @@
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from .utils import dotdict
+
+# operation currently running in each thread, for nested operations
+_current = threading.local()
+
+
+class OperationEvent:
+    """
+    Timing record of one client operation, passed to the instrumentation hooks.
+
+    `timings` maps phases to seconds. Every phase gets the time elapsed since
+    the previous one, so together they add up to about `duration`:
+
+    - `build`: building the query and its parameters
+    - `checkout`: waiting for a pooled connection
+    - `settings`: resolving session settings and prepared statements, the SET
+      statements themselves are sent along with the query
+    - `execute`: running the query, or the COPY, on the server
+    - `fetch`: transferring the result rows
+    - `decode`: turning rows into the returned result
+    - `commit`: committing the transaction
+
+    `rows` and `bytes_sent` count the rows returned or written and the query
+    and COPY bytes sent. `parent` is the event of the enclosing operation, if
+    any, and `context` is left free for the instrumentation, e.g. for a span.
+    """
+
+    __slots__ = (
+        "operation",
+        "table_name",
+        "parent",
+        "attributes",
+        "timings",
+        "rows",
+        "bytes_sent",
+        "error",
+        "start",
+        "duration",
+        "context",
+        "_last",
+    )
+
+    def __init__(self, operation, table_name=None, parent=None, attributes=None):
+        self.operation = operation
+        self.table_name = table_name
+        self.parent = parent
+        self.attributes = attributes or {}
+        self.timings = {}
+        self.rows = 0
+        self.bytes_sent = 0
+        self.error = None
+        self.duration = None
+        self.context = None
+        self.start = time.perf_counter()
+        self._last = self.start
+
+    def mark(self, phase, rows=0, bytes_sent=0):
+        now = time.perf_counter()
+        self.timings[phase] = self.timings.get(phase, 0.0) + now - self._last
+        self.rows += rows
+        self.bytes_sent += bytes_sent
+        self._last = now
+
+    def finish(self, error=None):
+        self.error = error
+        self.duration = time.perf_counter() - self.start
+
+    def as_dict(self):
+        return dotdict(
+            {
+                "operation": self.operation,
+                "table_name": self.table_name,
+                "attributes": dict(self.attributes),
+                "timings": dict(self.timings),
+                "rows": self.rows,
+                "bytes_sent": self.bytes_sent,
+                "error": None if self.error is None else repr(self.error),
+                "duration": self.duration,
+            }
+        )
+
+
+class Instrumentation:
+    """
+    Base class of instrumentation hooks.
+
+    `on_start` is called before an operation runs and `on_end` after it
+    finished or failed, both with its `OperationEvent` and in the calling
+    thread. Subclasses override them to feed tracers or metrics.
+    """
+
+    def on_start(self, event: OperationEvent):
+        pass
+
+    def on_end(self, event: OperationEvent):
+        pass
+
+
+class StatsInstrumentation(Instrumentation):
+    """
+    Aggregates counters per operation in the process: calls, errors, rows,
+    bytes sent, total seconds and total seconds per phase.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def on_end(self, event):
+        with self._lock:
+            stats = self._operations.get(event.operation)
+            if stats is None:
+                stats = dotdict(
+                    {
+                        "calls": 0,
+                        "errors": 0,
+                        "rows": 0,
+                        "bytes_sent": 0,
+                        "seconds": 0.0,
+                        "timings": {},
+                    }
+                )
+                self._operations[event.operation] = stats
+
+            stats.calls += 1
+            stats.errors += event.error is not None
+            stats.rows += event.rows
+            stats.bytes_sent += event.bytes_sent
+            stats.seconds += event.duration
+            for phase, seconds in event.timings.items():
+                stats.timings[phase] = stats.timings.get(phase, 0.0) + seconds
+
+    def stats(self):
+        with self._lock:
+            return dotdict(
+                {
+                    operation: dotdict(dict(stats, timings=dict(stats.timings)))
+                    for operation, stats in self._operations.items()
+                }
+            )
+
+    def reset(self):
+        with self._lock:
+            self._operations.clear()
+
+
+class CountingReader:
+    """File-like wrapper adding the bytes read from `f` to the event."""
+
+    def __init__(self, f, event):
+        self.f = f
+        self.event = event
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        if self.event is not None:
+            self.event.bytes_sent += len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self.f.readline(size)
+        if self.event is not None:
+            self.event.bytes_sent += len(data)
+        return data
+
+
+def current_event():
+    return getattr(_current, "event", None)
+
+
+def mark_event(phase, rows=0, bytes_sent=0):
+    """Attributes the time since the last phase of the running operation to `phase`."""
+    event = getattr(_current, "event", None)
+    if event is not None:
+        event.mark(phase, rows, bytes_sent)
+
+
+def annotate_event(**attributes):
+    event = getattr(_current, "event", None)
+    if event is not None:
+        event.attributes.update(attributes)
+
+
+@contextmanager
+def running_event(event):
+    """
+    Makes `event` the running operation of this thread for the block, so the
+    marks of work done in a worker thread on behalf of an operation are kept.
+    """
+    previous = getattr(_current, "event", None)
+    _current.event = event
+    try:
+        yield event
+    finally:
+        _current.event = previous
+
+
+def instrumented(method):
+    """
+    Reports a method call as an operation to the `instrumentation` of its
+    instance, named after the method, e.g. `SyncClient.search`. Without
+    instrumentation the method is called directly.
+    """
+    operation = method.__qualname__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return method(self, *args, **kwargs)
+
+        parent = getattr(_current, "event", None)
+        event = OperationEvent(
+            operation,
+            getattr(self, "table_name", None) or getattr(self, "name", None),
+            parent,
+        )
+        instrumentation.on_start(event)
+        _current.event = event
+        try:
+            result = method(self, *args, **kwargs)
+        except BaseException as e:
+            event.finish(e)
+            raise
+        else:
+            event.finish()
+        finally:
+            _current.event = parent
+            instrumentation.on_end(event)
+        return result
+
+    return wrapper
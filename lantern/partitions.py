@@ -0,0 +1,87 @@
+import heapq
+import itertools
+import json
+
+partition_methods = ("hash", "list")
+
+
+def check_partitions(partition_by, partitions):
+    if partition_by not in partition_methods:
+        raise (
+            Exception(
+                f"Invalid partition method {partition_by}, expected one of {partition_methods}"
+            )
+        )
+    if partition_by == "hash" and (not isinstance(partitions, int) or partitions < 1):
+        raise (Exception("Hash partitioning expects the number of partitions"))
+    if partition_by == "list" and (
+        isinstance(partitions, (int, str)) or len(partitions) == 0
+    ):
+        raise (Exception("List partitioning expects a list of partition values"))
+
+
+def get_partition_value(metadata, key):
+    """
+    Returns the partition value of a row, the text `metadata->>key` returns,
+    or None when the metadata does not have the key.
+    """
+    if isinstance(metadata, str):
+        metadata = json.loads(metadata)
+    if not isinstance(metadata, dict):
+        return None
+
+    value = metadata.get(key)
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def get_row_partition_value(metadata, key):
+    """
+    Returns the partition value of a written row. The partition column can
+    not be NULL, so rows whose metadata does not have the key are rejected.
+    """
+    value = get_partition_value(metadata, key)
+    if value is None:
+        raise (
+            Exception(
+                f"Rows of a table partitioned by '{key}' must have a '{key}' metadata value"
+            )
+        )
+    return value
+
+
+def escape_copy_text(value):
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def get_copy_partition_values(rows, key, update=False, merge_metadata=False):
+    """
+    Formats the partition values of `(id, embedding, metadata)` rows as COPY
+    fields. Update rows without metadata, or whose merged metadata does not
+    have the key, get NULL, which keeps the current partition of the row.
+    """
+    values = []
+    for row in rows:
+        metadata = row[2] if len(row) > 2 else None
+        if update and metadata is None:
+            values.append("\\N")
+        elif merge_metadata and get_partition_value(metadata, key) is None:
+            values.append("\\N")
+        else:
+            values.append(escape_copy_text(get_row_partition_value(metadata, key)))
+    return values
+
+
+def merge_results(results, limit):
+    """
+    Merges result rows sorted by their last column, the distance, and
+    returns the first `limit` of them.
+    """
+    merged = heapq.merge(*results, key=lambda row: row[-1])
+    return list(itertools.islice(merged, limit))
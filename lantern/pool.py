@@ -0,0 +1,322 @@
+import bisect
+import threading
+import time
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+from collections import deque
+from typing import Optional
+from .utils import (
+    dotdict,
+    get_dsn_key,
+    get_cached_max_db_connections,
+    probe_max_db_connections,
+)
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    pass
+
+
+class Histogram:
+    """Cumulative latency histogram with fixed bucket upper bounds in seconds."""
+
+    default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return dotdict(
+            {
+                "buckets": list(self.buckets) + [float("inf")],
+                "counts": list(self.counts),
+                "sum": self.sum,
+                "count": self.count,
+            }
+        )
+
+
+class ConnectionPool:
+    """
+    Thread-safe psycopg2 connection pool.
+
+    It is a drop-in replacement for `psycopg2.pool.SimpleConnectionPool`
+    (`getconn`, `putconn`, `closeall`) which can be shared by many threads:
+
+    - `getconn` blocks until a connection is free, for at most `timeout` seconds,
+      then raises `PoolTimeout`
+    - connections which were idle longer than `health_check_interval` seconds are
+      checked with `SELECT 1` on checkout, broken ones are replaced
+    - connections older than `max_lifetime` seconds are closed and reopened
+    - `minconn` connections are opened up front when `prewarm` is set
+    - `stats()` reports pool usage, wait time and a checkout latency histogram
+
+    When `maxconn` is None, the pool is sized from the cached connection limit
+    of the server, or else by probing it on the first connection the pool
+    opens, so no dedicated probe connection is ever made.
+
+    Any extra arguments are passed to `psycopg2.connect`.
+    """
+
+    def __init__(
+        self,
+        minconn: int,
+        maxconn: Optional[int],
+        *args,
+        timeout: Optional[float] = 30.0,
+        health_check_interval: Optional[float] = 30.0,
+        max_lifetime: Optional[float] = None,
+        prewarm: bool = True,
+        **kwargs,
+    ) -> None:
+        self._dsn_key = get_dsn_key(*args, **kwargs)
+        if maxconn is None:
+            cached = get_cached_max_db_connections(self._dsn_key)
+            maxconn = None if cached is None else max(cached, minconn, 1)
+        if maxconn is not None and (maxconn < 1 or minconn > maxconn):
+            raise psycopg2.pool.PoolError(
+                f"Invalid pool size minconn={minconn} maxconn={maxconn}"
+            )
+
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.max_lifetime = max_lifetime
+        self.closed = False
+
+        self._args = args
+        self._kwargs = kwargs
+        self._cond = threading.Condition()
+        # idle connections as (connection, created_at, returned_at), used LIFO
+        self._idle = deque()
+        self._in_use = {}
+        # slots reserved by getconn while a connection is opened or checked
+        self._opening = 0
+        self._waiting = 0
+
+        self._checkouts = 0
+        self._timeouts = 0
+        self._opened = 0
+        self._closed = 0
+        self._health_check_failures = 0
+        self._wait_time = 0.0
+        self._checkout_latency = Histogram()
+
+        if prewarm:
+            self.warm(minconn)
+
+    def _size(self):
+        return len(self._idle) + len(self._in_use) + self._opening
+
+    def _max_size(self):
+        # until the first connection has sized the pool, only it may be opened
+        return 1 if self.maxconn is None else self.maxconn
+
+    def _connect(self):
+        conn = psycopg2.connect(*self._args, **self._kwargs)
+        with self._cond:
+            self._opened += 1
+
+        if self.maxconn is None:
+            try:
+                maxconn = probe_max_db_connections(conn, self._dsn_key)
+            except:
+                self._close(conn)
+                raise
+            with self._cond:
+                if self.maxconn is None:
+                    self.maxconn = max(maxconn, self.minconn, 1)
+                    self._cond.notify_all()
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._closed += 1
+
+    def _expired(self, created_at, now):
+        return self.max_lifetime is not None and now - created_at >= self.max_lifetime
+
+    def _is_healthy(self, conn, returned_at, now):
+        if conn.closed:
+            return False
+        status = conn.info.transaction_status
+        if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if (
+            self.health_check_interval is None
+            or now - returned_at < self.health_check_interval
+        ):
+            return True
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def warm(self, count=None):
+        """Opens idle connections until the pool holds `count` (default `minconn`)."""
+        count = self.minconn if count is None else count
+        while True:
+            with self._cond:
+                if self.closed or self._size() >= min(count, self._max_size()):
+                    return
+                self._opening += 1
+            try:
+                conn = self._connect()
+            finally:
+                with self._cond:
+                    self._opening -= 1
+            now = time.monotonic()
+            with self._cond:
+                self._idle.append((conn, now, now))
+                self._cond.notify()
+
+    def getconn(self, key=None, timeout=None):
+        start = time.monotonic()
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else start + timeout
+
+        while True:
+            entry = None
+            with self._cond:
+                while True:
+                    if self.closed:
+                        raise psycopg2.pool.PoolError("connection pool is closed")
+                    # the slot stays reserved while the connection is checked
+                    if len(self._idle) > 0:
+                        entry = self._idle.pop()
+                        self._opening += 1
+                        break
+                    if self._size() < self._max_size():
+                        self._opening += 1
+                        break
+
+                    remaining = (
+                        None if deadline is None else deadline - time.monotonic()
+                    )
+                    if remaining is not None and remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout(
+                            f"Timed out after {timeout}s waiting for a connection, {self._max_size()} in use"
+                        )
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+
+            now = time.monotonic()
+            if entry is not None:
+                conn, created_at, returned_at = entry
+                if self._expired(created_at, now) or not self._is_healthy(
+                    conn, returned_at, now
+                ):
+                    self._close(conn)
+                    with self._cond:
+                        if not self._expired(created_at, now):
+                            self._health_check_failures += 1
+                        self._opening -= 1
+                        self._cond.notify()
+                    continue
+            else:
+                try:
+                    conn = self._connect()
+                except:
+                    with self._cond:
+                        self._opening -= 1
+                        self._cond.notify()
+                    raise
+                created_at = now
+
+            latency = time.monotonic() - start
+            with self._cond:
+                self._opening -= 1
+                self._in_use[conn] = created_at
+                self._checkouts += 1
+                self._wait_time += latency
+                self._checkout_latency.observe(latency)
+            return conn
+
+    def putconn(self, conn=None, key=None, close=False):
+        with self._cond:
+            if self.closed:
+                # closeall already closed the connection
+                self._in_use.pop(conn, None)
+                return
+            if conn not in self._in_use:
+                raise psycopg2.pool.PoolError("trying to put unkeyed connection")
+            created_at = self._in_use[conn]
+
+        # the connection still counts as in use while it is being reset
+        if not close and not self.closed and not conn.closed:
+            status = conn.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except Exception:
+                    close = True
+
+        now = time.monotonic()
+        close = close or self.closed or conn.closed or self._expired(created_at, now)
+        with self._cond:
+            del self._in_use[conn]
+            if not close:
+                self._idle.append((conn, created_at, now))
+            self._cond.notify()
+
+        if close:
+            self._close(conn)
+
+    def closeall(self):
+        with self._cond:
+            self.closed = True
+            connections = [entry[0] for entry in self._idle] + list(self._in_use)
+            self._idle.clear()
+            self._cond.notify_all()
+
+        for conn in connections:
+            self._close(conn)
+
+    def stats(self):
+        """
+        Returns pool usage and checkout metrics.
+
+        `wait_time` is the total time spent in `getconn` and
+        `checkout_latency` a histogram of individual `getconn` calls.
+        """
+        with self._cond:
+            return dotdict(
+                {
+                    "size": self._size(),
+                    "max_size": self.maxconn,
+                    "idle": len(self._idle),
+                    "in_use": len(self._in_use),
+                    "waiting": self._waiting,
+                    "checkouts": self._checkouts,
+                    "timeouts": self._timeouts,
+                    "connections_opened": self._opened,
+                    "connections_closed": self._closed,
+                    "health_check_failures": self._health_check_failures,
+                    "wait_time": self._wait_time,
+                    "checkout_latency": self._checkout_latency.snapshot(),
+                }
+            )
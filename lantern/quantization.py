@@ -0,0 +1,60 @@
+import numpy as np
+from .utils import to_vector_param
+
+quantization_types = ("binary",)
+
+
+def check_quantization(quantization):
+    if quantization is not None and quantization not in quantization_types:
+        raise (
+            Exception(
+                f"Invalid quantization {quantization}, expected one of {quantization_types}"
+            )
+        )
+
+
+def get_binary_words(dimensions):
+    """Number of int32 words holding the sign bits of `dimensions` values."""
+    return (dimensions + 31) // 32
+
+
+def binarize(embeddings):
+    """
+    Sign-binarizes a batch of embeddings in one pass.
+
+    Bit i of a row is set when its i-th value is positive. The bits are
+    packed 32 per int32 word, the INTEGER[] values the hamming operator
+    class of lantern_hnsw indexes, so the hamming distance of two rows
+    counts the dimensions whose sign differs.
+
+    Args:
+        embeddings: (n, dim) matrix, or a single embedding.
+
+    Returns:
+        np.ndarray: (n, words) int32 matrix, see `get_binary_words`.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if embeddings.ndim == 1:
+        embeddings = embeddings[None, :]
+    n, dim = embeddings.shape
+
+    bits = np.packbits(embeddings > 0, axis=1, bitorder="little")
+    words = np.zeros((n, get_binary_words(dim) * 4), dtype=np.uint8)
+    words[:, : bits.shape[1]] = bits
+    return words.view("<i4")
+
+
+def get_copy_bits(rows):
+    """
+    Formats the sign bits of `(id, embedding, ...)` rows as COPY fields. The
+    embeddings of the rows are binarized together, rows without an
+    embedding, which update rows allow, get NULL bits.
+    """
+    embeddings = [to_vector_param(row[1]) if len(row) > 1 else None for row in rows]
+    present = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+    values = ["\\N"] * len(rows)
+    if len(present) > 0:
+        bits = binarize([embeddings[i] for i in present])
+        for i, row_bits in zip(present, bits.tolist()):
+            values[i] = "{" + ",".join(map(str, row_bits)) + "}"
+    return values
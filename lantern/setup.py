@@ -25,4 +25,5 @@ setuptools.setup(
     package_dir={"lantern": "."},
     python_requires=">=3.8",
     install_requires=["psycopg2-binary ==2.9.10", "numpy"],
+    extras_require={"async": ["psycopg[binary] >=3.1", "psycopg-pool >=3.1"]},
 )
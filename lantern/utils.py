@@ -1,22 +1,219 @@
 import psycopg2
+import psycopg2.extensions
 import re
 import itertools
 import json
+import hashlib
+import struct
+import threading
+import time
+import uuid
+import weakref
+import numpy as np
+from collections import OrderedDict
+from io import BytesIO
+
+
+max_db_connections_query = "SELECT greatest(1, ((SELECT setting::int FROM pg_settings WHERE name='max_connections')-(SELECT count(*) FROM pg_stat_activity) - 4)::int)"
+
+
+# probed connection limits, keyed by connection string
+max_db_connections_cache = {}
+max_db_connections_lock = threading.Lock()
+
+
+def get_dsn_key(dsn=None, **kwargs):
+    """Returns the connection string identifying a `psycopg2.connect` target."""
+    kwargs = {
+        k: v
+        for k, v in kwargs.items()
+        if k not in ("connection_factory", "cursor_factory")
+    }
+    return psycopg2.extensions.make_dsn(dsn, **kwargs)
+
+
+def get_cached_max_db_connections(dsn_key):
+    with max_db_connections_lock:
+        return max_db_connections_cache.get(dsn_key)
+
+
+def cache_max_db_connections(dsn_key, num_connections):
+    with max_db_connections_lock:
+        max_db_connections_cache[dsn_key] = num_connections
+    return num_connections
+
+
+def probe_max_db_connections(conn, dsn_key):
+    """
+    Runs the connection limit probe on an already open connection and
+    caches the result, so no extra connection is opened for it.
+    """
+    with conn.cursor() as cur:
+        cur.execute(max_db_connections_query)
+        num_connections = cur.fetchone()[0]
+    conn.rollback()
+    return cache_max_db_connections(dsn_key, num_connections)
 
 
 def default_max_db_connections(db_url):
+    num_connections = get_cached_max_db_connections(db_url)
+    if num_connections is not None:
+        return num_connections
+
     conn = psycopg2.connect(dsn=db_url)
-    with conn.cursor() as cur:
+    try:
+        return probe_max_db_connections(conn, db_url)
+    finally:
+        conn.close()
+
+
+# GUC values known to be in effect on each pooled connection
+session_settings = weakref.WeakKeyDictionary()
+session_settings_lock = threading.Lock()
+
+
+def get_session_settings_query(conn, settings):
+    """
+    Returns the SET statements needed to bring a connection to the given settings.
+
+    Settings already in effect on the connection are skipped. The returned
+    values are recorded as applied, so callers must run the statements in the
+    current transaction and call `forget_session_settings` if it fails.
+
+    Args:
+        conn: The database connection.
+        settings (dict): Setting names mapped to their values. A None value
+            resets a setting this function changed before to its default.
+
+    Returns:
+        str: The SET statements, or an empty string if nothing changes.
+    """
+    with session_settings_lock:
+        current = session_settings.get(conn)
+        if current is None:
+            current = {}
+            session_settings[conn] = current
+
+    statements = ""
+    for name, value in settings.items():
+        if value is None:
+            if current.get(name) is not None:
+                statements += f"RESET {name}; "
+                current[name] = None
+            continue
+
+        value = str(value).lower()
+        if current.get(name) != value:
+            statements += f"SET {name}={value}; "
+            current[name] = value
+    return statements
+
+
+def forget_session_settings(conn):
+    with session_settings_lock:
+        session_settings.pop(conn, None)
+        # a failed transaction leaves it unknown whether a PREPARE ran
+        prepared_statements.pop(conn, None)
+
+
+# Names of the server-side prepared statements on each pooled connection,
+# least recently executed first
+prepared_statements = weakref.WeakKeyDictionary()
+
+# Statements prepared per connection before the least recently used is deallocated
+max_prepared_statements = 64
+
+
+def get_prepared_query(
+    conn, cur, query_string, params, max_statements=max_prepared_statements
+):
+    """
+    Rewrites a query with dollar sign parameters into an EXECUTE of a
+    server-side prepared statement.
+
+    The statement is named after a hash of the query text. If the connection
+    does not have it yet, the PREPARE is prepended to the EXECUTE so both are
+    sent in one round trip. When the statements of a connection are unknown,
+    they are loaded from `pg_prepared_statements` first.
+
+    Query texts that differ in their inlined values, such as the LIMIT,
+    are distinct statements, so at most `max_statements` are kept per
+    connection. Past that, the least recently executed one is deallocated
+    in the same round trip.
+
+    Args:
+        conn: The database connection.
+        cur: A cursor of the connection.
+        query_string (str): The query string with dollar sign parameters.
+        params (list): List of parameter values.
+        max_statements (int): Maximum number of prepared statements kept on
+            the connection.
+
+    Returns:
+        str: The pyformat query string to execute.
+        dict: A dictionary mapping parameter numbers to their values.
+    """
+    query_string = query_string.strip().rstrip(";")
+    name = "lantern_" + hashlib.md5(query_string.encode("utf-8")).hexdigest()[:16]
+
+    with session_settings_lock:
+        prepared = prepared_statements.get(conn)
+    if prepared is None:
         cur.execute(
-            "SELECT greatest(1, ((SELECT setting::int FROM pg_settings WHERE name='max_connections')-(SELECT count(*) FROM pg_stat_activity) - 4)::int)"
+            "SELECT name FROM pg_prepared_statements WHERE name LIKE 'lantern\\_%' ORDER BY prepare_time"
         )
-        num_connections = cur.fetchone()
-    conn.close()
-    return num_connections[0]
+        prepared = OrderedDict((row[0], None) for row in cur.fetchall())
+        with session_settings_lock:
+            prepared_statements[conn] = prepared
+
+    statements = ""
+    if name in prepared:
+        prepared.move_to_end(name)
+    else:
+        prepared[name] = None
+        while len(prepared) > max_statements:
+            evicted, _ = prepared.popitem(last=False)
+            statements += "DEALLOCATE {name}; ".format(name=evicted)
+        statements += "PREPARE {name} AS {query}; ".format(
+            name=name, query=query_string.replace("%", "%%")
+        )
+
+    execute = "EXECUTE {name}({params})".format(
+        name=name, params=", ".join(f"${idx + 1}" for idx in range(len(params)))
+    )
+    execute, params = translate_to_pyformat(execute, params)
+    return statements + execute, params
+
+
+real_array_oid = 1021
+
+
+def parse_real_array(value, cur=None):
+    """
+    Parses the text representation of a REAL[] value into a float32 array
+    in a single pass, without creating a python float per element.
+    """
+    if value is None:
+        return None
+    return np.fromstring(value[1:-1], dtype=np.float32, sep=",")
+
+
+REAL_ARRAY_NUMPY = psycopg2.extensions.new_type(
+    (real_array_oid,), "REAL_ARRAY_NUMPY", parse_real_array
+)
+
+
+def register_numpy_embeddings(conn_or_curs):
+    """
+    Makes REAL[] columns load as float32 numpy arrays on a psycopg2
+    connection or cursor.
+    """
+    psycopg2.extensions.register_type(REAL_ARRAY_NUMPY, conn_or_curs)
 
 
 def get_select_fields(select):
-    return "*" if len(select) == 0 else ",".join(select)
+    # the columns of the results, derived columns of the table are left out
+    return "id, metadata, embedding" if len(select) == 0 else ",".join(select)
 
 
 translated_queries = {}
@@ -43,16 +240,15 @@ def translate_to_pyformat(query_string, params):
     if query_string in translated_queries:
         return translated_queries[query_string], translated_params
 
-    dollar_params = re.findall(r"\$[0-9]+", query_string)
-    translated_string = query_string
-    for dollar_param in dollar_params:
+    def get_pyformat_param(match):
         # Extract the number after the $
-        param_number = int(dollar_param[1:])
+        param_number = int(match.group(0)[1:])
         if params != None:
-            pyformat_param = "%s" if param_number == 0 else f"%({param_number})s"
-        else:
-            pyformat_param = "%s"
-        translated_string = translated_string.replace(dollar_param, pyformat_param)
+            return "%s" if param_number == 0 else f"%({param_number})s"
+        return "%s"
+
+    # a single pass, so that replacing $1 does not touch $10
+    translated_string = re.sub(r"\$[0-9]+", get_pyformat_param, query_string)
 
     translated_queries[query_string] = translated_string
     return translated_queries[query_string], translated_params
@@ -87,22 +283,22 @@ def index_of(l, s):
         return -1
 
 
-def get_vector_result(rows=[], select_fields=[], first=False):
-    id_idx = -1
-    embedding_idx = -1
-    metadata_idx = -1
+def get_field_indices(select_fields=[]):
+    if len(select_fields) == 0:
+        return (0, 2, 1)
 
+    return (
+        index_of(select_fields, "id"),
+        index_of(select_fields, "embedding"),
+        index_of(select_fields, "metadata"),
+    )
+
+
+def get_vector_result(rows=[], select_fields=[], first=False):
     if len(rows) == 0:
         return [] if not first else None
 
-    if len(select_fields) == 0:
-        id_idx = 0
-        metadata_idx = 1
-        embedding_idx = 2
-    else:
-        id_idx = index_of(select_fields, "id")
-        embedding_idx = index_of(select_fields, "embedding")
-        metadata_idx = index_of(select_fields, "metadata")
+    id_idx, embedding_idx, metadata_idx = get_field_indices(select_fields)
 
     results = []
 
@@ -128,12 +324,300 @@ def get_vector_result(rows=[], select_fields=[], first=False):
     return results
 
 
+def get_numpy_result(rows=[], select_fields=[], dimensions=None, with_distance=True):
+    """
+    Builds a columnar result from query rows.
+
+    Args:
+        rows (list): Rows as returned by the query.
+        select_fields (list): The selected fields.
+        dimensions (int, optional): Embedding dimensions, used to shape empty results.
+        with_distance (bool): Whether the last column of each row is the distance.
+
+    Returns:
+        dotdict: `ids` array, `distances` float32 array, `embeddings` contiguous
+        float32 (n, dimensions) matrix and `metadata` list. Fields which were
+        not selected are None.
+    """
+    id_idx, embedding_idx, metadata_idx = get_field_indices(select_fields)
+    columns = list(zip(*rows)) if len(rows) > 0 else None
+
+    def column(idx):
+        return [] if columns is None else columns[idx]
+
+    result = dotdict({"ids": None, "distances": None, "embeddings": None, "metadata": None})
+
+    if id_idx > -1:
+        result.ids = np.array(column(id_idx))
+    if embedding_idx > -1:
+        if columns is None:
+            result.embeddings = np.empty((0, dimensions or 0), dtype=np.float32)
+        else:
+            result.embeddings = np.ascontiguousarray(
+                np.array(column(embedding_idx), dtype=np.float32)
+            )
+    if metadata_idx > -1:
+        result.metadata = list(column(metadata_idx))
+    if with_distance:
+        result.distances = np.array(column(-1), dtype=np.float32)
+
+    return result
+
+
+output_types = ("dotdict", "numpy")
+
+
+def check_output_type(output):
+    if output not in output_types:
+        raise (Exception(f"Invalid output {output}, expected one of {output_types}"))
+
+
+def get_output_result(rows, select_fields, output, dimensions=None, with_distance=True):
+    if output == "numpy":
+        return get_numpy_result(rows, select_fields, dimensions, with_distance)
+    return get_vector_result(rows, select_fields)
+
+
+def to_vector_param(vec):
+    if isinstance(vec, np.ndarray):
+        return vec.tolist()
+    return vec
+
+
 def prepare_insert_data(row):
     id = row[0]
-    vec = row[1]
+    vec = to_vector_param(row[1])
     metadata = "null" if len(row) < 3 else row[2]
 
     if type(metadata) != str:
         metadata = json.dumps(metadata)
 
     return (id, vec, metadata)
+
+
+def get_unique_rows(rows, last=True):
+    """
+    Keeps one row per id, the first element of a row, in the order the ids
+    first appear. With `last` the last row of an id is kept, otherwise the
+    first one.
+    """
+    unique = {}
+    for row in rows:
+        if last or row[0] not in unique:
+            unique[row[0]] = row
+    return list(unique.values())
+
+
+def to_array_literal(vec):
+    return "{" + ",".join(map(str, vec)) + "}"
+
+
+def escape_copy_metadata(metadata):
+    return metadata.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def get_copy_line(row):
+    id, embedding, metadata = prepare_insert_data(row)
+    metadata = escape_copy_metadata(metadata)
+    return f"{id}\t{metadata}\t{{{str(embedding)[1:-1]}}}"
+
+
+def get_update_copy_line(row):
+    """
+    Formats an `(id, embedding, metadata)` update row as a COPY line, the
+    embedding and metadata may be None or omitted and are then sent as NULL.
+    """
+    id = row[0]
+    embedding = to_vector_param(row[1]) if len(row) > 1 else None
+    metadata = row[2] if len(row) > 2 else None
+
+    if metadata is None:
+        metadata = "\\N"
+    else:
+        if type(metadata) != str:
+            metadata = json.dumps(metadata)
+        metadata = escape_copy_metadata(metadata)
+
+    embedding = "\\N" if embedding is None else f"{{{str(embedding)[1:-1]}}}"
+    return f"{id}\t{metadata}\t{embedding}"
+
+
+def format_copy_chunk(rows, format_line=get_copy_line, extra_columns=()):
+    """
+    Formats rows as COPY lines. Every function of `extra_columns` returns
+    the COPY fields of one more column for all the rows of the chunk.
+    """
+    lines = map(format_line, rows)
+    if len(extra_columns) > 0:
+        columns = [get_column(rows) for get_column in extra_columns]
+        lines = ("\t".join(fields) for fields in zip(lines, *columns))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def get_copy_chunks(
+    rows,
+    chunk_size=10000,
+    progress=None,
+    format_line=get_copy_line,
+    format_chunk=format_copy_chunk,
+):
+    """
+    Formats an iterable of rows into COPY text chunks of at most `chunk_size` rows.
+
+    Args:
+        rows (iterable): Rows accepted by `format_line`, may be a generator.
+        chunk_size (int): Number of rows formatted per chunk.
+        progress (callable, optional): Called as `progress(rows, rows_per_second)`
+            each time a chunk has been handed to the consumer.
+        format_line (callable): Formats a single row as a COPY line.
+        format_chunk (callable): Formats a list of rows with `format_line`.
+
+    Yields:
+        bytes: Newline terminated COPY lines for one chunk.
+    """
+    start = time.monotonic()
+    total = 0
+    for chunk in chunks(rows, chunk_size):
+        yield format_chunk(chunk, format_line)
+        total += len(chunk)
+        if progress is not None:
+            elapsed = time.monotonic() - start
+            progress(total, total / elapsed if elapsed > 0 else 0.0)
+
+
+class CopyStream:
+    """
+    File-like object that feeds `copy_expert` from a chunk generator.
+
+    Only one chunk is held in memory at a time and the next chunk is
+    formatted while the server is still ingesting the previous one.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b""
+        self._pos = 0
+
+    def read(self, size=-1):
+        if self._pos >= len(self._buf):
+            self._buf = next(self._chunks, b"")
+            self._pos = 0
+
+        if size is None or size < 0:
+            size = len(self._buf)
+        data = self._buf[self._pos : self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+# Header of the COPY binary format: signature, flags and header extension length
+binary_copy_header = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+binary_copy_trailer = struct.pack(">h", -1)
+float4_oid = 700
+int4_oid = 23
+
+
+def get_binary_id_encoder(id_type):
+    id_type = id_type.lower()
+    if id_type in ("text", "varchar", "character varying"):
+        return lambda id: str(id).encode("utf-8")
+    elif id_type in ("smallint", "int2"):
+        return lambda id: struct.pack(">h", int(id))
+    elif id_type in ("int", "integer", "int4", "serial"):
+        return lambda id: struct.pack(">i", int(id))
+    elif id_type in ("bigint", "int8", "bigserial"):
+        return lambda id: struct.pack(">q", int(id))
+    elif id_type == "uuid":
+        return lambda id: (id if isinstance(id, uuid.UUID) else uuid.UUID(str(id))).bytes
+
+    raise (Exception(f"Binary COPY does not support id type {id_type}"))
+
+
+def get_binary_copy_payload(
+    ids, embeddings, metadata=None, id_type="text", bits=None, partition_values=None
+):
+    """
+    Encodes a batch of rows into the COPY binary format for the
+    (id, metadata, embedding) column list, followed by `embedding_bits`
+    when `bits` are given and `partition_value` when `partition_values` are.
+
+    Embeddings are converted to big-endian float4 in one pass over the
+    matrix buffer, so no per-element python objects are created.
+
+    Args:
+        ids (list): Row ids.
+        embeddings (np.ndarray): (n, dim) matrix of embeddings.
+        metadata (list, optional): Per-row metadata as dicts or JSON strings.
+        id_type (str): SQL type of the id column.
+        bits (np.ndarray, optional): (n, words) int32 matrix of sign bits.
+        partition_values (list, optional): Per-row partition values.
+
+    Returns:
+        BytesIO: The payload positioned at the start.
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if embeddings.ndim != 2:
+        raise (Exception("Embeddings must be a 2-dimensional array"))
+
+    n, dim = embeddings.shape
+    if len(ids) != n:
+        raise (Exception(f"Got {len(ids)} ids for {n} embeddings"))
+    if metadata is not None and len(metadata) != n:
+        raise (Exception(f"Got {len(metadata)} metadata entries for {n} embeddings"))
+
+    # every array element is stored as int32 length followed by the value
+    values = np.empty((n, dim), dtype=[("len", ">i4"), ("value", ">f4")])
+    values["len"] = 4
+    values["value"] = embeddings
+    values = values.tobytes()
+    row_size = 8 * dim
+
+    # field length, ndim, has_nulls, element type, dimension size, lower bound
+    embedding_header = struct.pack(">iiiiii", 20 + row_size, 1, 0, float4_oid, dim, 1)
+    encode_id = get_binary_id_encoder(id_type)
+    field_count = struct.pack(
+        ">h", 3 + (bits is not None) + (partition_values is not None)
+    )
+
+    if bits is not None:
+        words = bits.shape[1]
+        bits_values = np.empty((n, words), dtype=[("len", ">i4"), ("value", ">i4")])
+        bits_values["len"] = 4
+        bits_values["value"] = bits
+        bits_values = bits_values.tobytes()
+        bits_size = 8 * words
+        bits_header = struct.pack(">iiiiii", 20 + bits_size, 1, 0, int4_oid, words, 1)
+
+    f = BytesIO()
+    f.write(binary_copy_header)
+    for i in range(n):
+        id = encode_id(ids[i])
+        meta = "null" if metadata is None else metadata[i]
+        if type(meta) != str:
+            meta = json.dumps(meta)
+        # jsonb binary representation is a version byte followed by the text
+        meta = b"\x01" + meta.encode("utf-8")
+
+        f.write(field_count)
+        f.write(struct.pack(">i", len(id)))
+        f.write(id)
+        f.write(struct.pack(">i", len(meta)))
+        f.write(meta)
+        f.write(embedding_header)
+        f.write(values[i * row_size : (i + 1) * row_size])
+        if bits is not None:
+            f.write(bits_header)
+            f.write(bits_values[i * bits_size : (i + 1) * bits_size])
+        if partition_values is not None:
+            if partition_values[i] is None:
+                f.write(struct.pack(">i", -1))
+            else:
+                value = partition_values[i].encode("utf-8")
+                f.write(struct.pack(">i", len(value)))
+                f.write(value)
+    f.write(binary_copy_trailer)
+    f.seek(0)
+    return f
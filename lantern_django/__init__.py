@@ -1,7 +1,10 @@
+from contextlib import contextmanager
 from django.contrib.postgres.operations import CreateExtension
 from django.contrib.postgres.indexes import PostgresIndex
+from django.db import DEFAULT_DB_ALIAS, connections
 from django.db.models import FloatField, Func, Value
 import numpy as np
+import time
 
 
 __all__ = [
@@ -10,6 +13,8 @@ __all__ = [
     "L2Distance",
     "CosineDistance",
     "HnswIndex",
+    "QueryEvent",
+    "instrument",
 ]
 
 
@@ -126,3 +131,65 @@ class ImageEmbedding(Func):
         if not hasattr(text, "resolve_expression"):
             text = Value(text)
         super().__init__(Value(model), text, **extra)
+
+
+class QueryEvent:
+    """
+    Timing record of a query using lantern distance expressions, with the
+    fields of `lantern.OperationEvent`, so the same instrumentation can
+    handle both.
+    """
+
+    def __init__(self, operation, sql, parent=None):
+        self.operation = operation
+        self.table_name = None
+        self.parent = parent
+        self.attributes = {"sql": sql}
+        self.timings = {}
+        self.rows = 0
+        self.bytes_sent = 0
+        self.error = None
+        self.duration = None
+        self.context = None
+        self.start = time.perf_counter()
+
+    def finish(self, error=None):
+        self.error = error
+        self.duration = time.perf_counter() - self.start
+        self.timings["execute"] = self.duration
+
+
+distance_operators = tuple(
+    cls.arg_joiner for cls in (L2Distance, HammingDistance, CosineDistance)
+)
+
+
+@contextmanager
+def instrument(instrumentation, using=DEFAULT_DB_ALIAS):
+    """
+    Reports the queries using lantern distance expressions which run on the
+    connection inside the block to `instrumentation`, an object with
+    `on_start(event)` and `on_end(event)` hooks such as `lantern.Instrumentation`.
+    Queries outside of the block are not wrapped at all.
+    """
+
+    def wrapper(execute, sql, params, many, context):
+        if not any(operator in sql for operator in distance_operators):
+            return execute(sql, params, many, context)
+
+        event = QueryEvent("django.distance_query", sql)
+        instrumentation.on_start(event)
+        try:
+            result = execute(sql, params, many, context)
+        except BaseException as e:
+            event.finish(e)
+            raise
+        else:
+            event.finish()
+            event.rows = max(context["cursor"].rowcount, 0)
+        finally:
+            instrumentation.on_end(event)
+        return result
+
+    with connections[using].execute_wrapper(wrapper):
+        yield
@@ -2,22 +2,21 @@ import json
 import os
 import math
 import threading
-import psycopg2.pool
 import pinecone
 from contextlib import contextmanager
 from typing import List, Optional
 from pinecone.core.client.model.vector import Vector
 from tqdm import tqdm
-from lantern import QueryBuilder, SyncClient
+from lantern import ConnectionPool, QueryBuilder, SyncClient, instrumented
 from lantern.utils import (
     chunks,
-    default_max_db_connections,
     dotdict,
     norm,
     translate_to_pyformat,
 )
 
 global_pool = None
+global_instrumentation = None
 indexes_table_name = "lantern_index_metadata"
 
 
@@ -27,8 +26,11 @@ class IndexStatusReady:
 
 
 class Index:
-    def __init__(self, index_name: str, ef=None, pool=None) -> None:
+    def __init__(
+        self, index_name: str, ef=None, pool=None, instrumentation=None
+    ) -> None:
         self.pool = pool or global_pool
+        self.instrumentation = instrumentation or global_instrumentation
         self.name = index_name
         self.namespace_clients = {}
         self.namespace_table_name = QueryBuilder._quote_ident(
@@ -54,6 +56,7 @@ class Index:
                 m=self.m,
                 ef=self.ef,
                 ef_construction=self.ef_construction,
+                instrumentation=self.instrumentation,
             )
 
     @contextmanager
@@ -97,6 +100,7 @@ class Index:
             table_name=f"{self.name}_{namespace}",
             dimensions=self.dimensions,
             distance_type=self.metric,
+            instrumentation=self.instrumentation,
         )
 
         with self._connect() as conn:
@@ -144,6 +148,7 @@ class Index:
             return self._add_namespace(namespace)
         return client
 
+    @instrumented
     def upsert(self, vectors, copy=False, namespace=""):
         values = []
         for data in vectors:
@@ -174,9 +179,11 @@ class Index:
             self._get_client(namespace).upsert_many(values)
         return len(values)
 
+    @instrumented
     def delete(self, ids, namespace=""):
         self._get_client(namespace).delete_by_ids(ids)
 
+    @instrumented
     def fetch(self, ids, namespace=""):
         results = self._get_client(namespace).get_by_ids(
             ids, ["id", "metadata", "embedding"]
@@ -188,6 +195,7 @@ class Index:
 
         return {"namespace": namespace, "vectors": vectors}
 
+    @instrumented
     def query(
         self,
         vector=None,
@@ -226,6 +234,7 @@ class Index:
     def update(self, id, values=None, set_metadata=None, namespace=""):
         pass
 
+    @instrumented
     def describe_index_stats(self):
         total_count = 0
         namespaces = {}
@@ -305,7 +314,7 @@ def init(url: Optional[str] = None, **kwargs):
     connect(url, **kwargs)
 
 
-def connect(db_url=None, **kwargs):
+def connect(db_url=None, max_db_connections=None, instrumentation=None, **kwargs):
     """
     Create a new connection.
 
@@ -329,13 +338,18 @@ def connect(db_url=None, **kwargs):
     - *password*: password used to authenticate
     - *host*: database host address (defaults to UNIX socket if not provided)
     - *port*: connection port number (defaults to 5432 if not provided)
+
+    The pool holds at most `max_db_connections` connections. When it is not
+    given, the limit is probed on the first connection of the pool.
+
+    `instrumentation` is a `lantern.Instrumentation` receiving the operations
+    of every `Index`.
     """
-    global global_pool
-    max_db_connections = default_max_db_connections(db_url, **kwargs)
+    global global_pool, global_instrumentation
+    global_instrumentation = instrumentation
 
-    global_pool = psycopg2.pool.SimpleConnectionPool(
-        1, max_db_connections, dsn=db_url, **kwargs
-    )
+    # the pool is shared by the threads of `_create_using_pinecone_ids_parallel`
+    global_pool = ConnectionPool(1, max_db_connections, dsn=db_url, **kwargs)
 
     conn = global_pool.getconn()
     try:
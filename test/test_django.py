@@ -15,6 +15,7 @@ from lantern_django import (
     CosineDistance,
     RealField,
     TextEmbedding,
+    instrument,
 )
 from unittest import mock
 from urllib.parse import urlparse
@@ -177,3 +178,25 @@ class TestDjango:
     def test_missing(self):
         Item().save()
         assert Item.objects.first().embedding is None
+
+    def test_instrument(self):
+        create_items()
+        events = []
+
+        class Recorder:
+            def on_start(self, event):
+                pass
+
+            def on_end(self, event):
+                events.append(event)
+
+        distance = L2Distance("embedding", [1, 1, 1] + [0] * 381)
+        with instrument(Recorder()):
+            items = list(Item.objects.annotate(distance=distance).order_by(distance))
+            Item.objects.count()
+        list(Item.objects.annotate(distance=distance))
+
+        assert len(events) == 1
+        assert events[0].operation == "django.distance_query"
+        assert events[0].rows == len(items)
+        assert events[0].duration > 0
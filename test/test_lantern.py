@@ -1,5 +1,15 @@
-from lantern import SyncClient
+from lantern import (
+    SyncClient,
+    SearchCache,
+    Instrumentation,
+    StatsInstrumentation,
+    FilterUsage,
+)
+from lantern.benchmark import generate_dataset, ground_truth, run_benchmark, get_sweep
+from lantern.utils import translate_to_pyformat
+import numpy as np
 import os
+import threading
 
 DB_URL = os.environ.get("DB_URL")
 
@@ -75,6 +85,9 @@ def test_client():
     assert vectors[0].id == "4"
     assert vectors[0].distance == 0
 
+    # Searching by an ID which does not exist returns no results
+    assert client.search(query_id="404") == []
+
     # Search for vectors using the embedding of the vector with ID "4"
     # Limit the results to 2 and apply a filter on the metadata
     vectors = client.search(
@@ -100,3 +113,974 @@ def test_client():
     assert vectors[0].id == "1"
     assert vectors[0].metadata is None
     assert vectors[0].embedding is None
+
+
+def test_bulk_insert_binary():
+    client = SyncClient(
+        url=DB_URL,
+        table_name="small_world_binary",
+        dimensions=3,
+        distance_type="l2sq",
+    )
+    client.drop()
+    client.create_table()
+
+    embeddings = np.array([[0, 0, 0], [0, 1, 0], [0, 0, 1.5]], dtype=np.float32)
+    client.bulk_insert_binary(
+        ["1", "2", "3"], embeddings, [{"name": "a"}, {"name": "b"}, None]
+    )
+    assert client.count() == 3
+
+    vec_by_id = client.get_by_id(id="3", select_fields=["id", "embedding", "metadata"])
+    assert vec_by_id.embedding == [0, 0, 1.5]
+    assert vec_by_id.metadata is None
+
+    vec_by_id = client.get_by_id(id="2", select_fields=["id", "metadata"])
+    assert vec_by_id.metadata["name"] == "b"
+
+    client.drop()
+
+
+def test_bulk_insert_stream():
+    client = SyncClient(
+        url=DB_URL,
+        table_name="small_world_stream",
+        dimensions=3,
+        distance_type="l2sq",
+    )
+    client.drop()
+    client.create_table()
+
+    progress = []
+    rows = ((str(i), [i, i, i], {"n": i}) for i in range(1000))
+    client.bulk_insert(
+        rows, chunk_size=300, progress=lambda n, rate: progress.append(n)
+    )
+    assert client.count() == 1000
+    assert progress == [300, 600, 900, 1000]
+
+    client.drop()
+
+
+def test_parallel_bulk_insert():
+    client = SyncClient(
+        url=DB_URL,
+        table_name="small_world_parallel",
+        dimensions=3,
+        distance_type="l2sq",
+    )
+    client.drop()
+    client.create_table()
+
+    rows = ((str(i), [i, i, i], {"n": i}) for i in range(1000))
+    result = client.parallel_bulk_insert(rows, num_connections=3, chunk_size=100)
+    assert result.rows == 1000
+    assert len(result.connections) == 3
+    assert sum(stream.rows for stream in result.connections) == 1000
+    assert client.count() == 1000
+
+    client.drop()
+
+
+def test_search_many():
+    client = SyncClient(
+        url=DB_URL,
+        table_name="small_world_many",
+        dimensions=3,
+        distance_type="l2sq",
+    )
+    client.drop()
+    client.create_table()
+    client.bulk_insert(
+        [
+            ("1", [0, 0, 0], {"name": "a"}),
+            ("2", [0, 1, 0], {"name": "b"}),
+            ("3", [0, 0, 1], {"name": "c"}),
+        ]
+    )
+    client.create_index()
+
+    results = client.search_many([[0, 0, 1], [0, 1, 0], [0, 0, 0]], limit=2)
+    assert len(results) == 3
+    assert [len(r) for r in results] == [2, 2, 2]
+    assert [r[0].id for r in results] == ["3", "2", "1"]
+    assert results[0][0].distance == 0
+
+    results = client.search_many(
+        np.array([[0, 0, 1], [0, 1, 0]], dtype=np.float32),
+        limit=2,
+        filter={"name": "a"},
+        select_fields=["id"],
+    )
+    assert [[v.id for v in r] for r in results] == [["1"], ["1"]]
+    assert results[0][0].metadata is None
+
+    client.drop()
+
+
+def test_search_session_settings():
+    client = SyncClient(
+        url=DB_URL,
+        table_name="small_world_settings",
+        dimensions=3,
+        distance_type="l2sq",
+        max_db_connections=1,
+    )
+    client.drop()
+    client.create_table()
+    client.bulk_insert(
+        [("1", [0, 0, 0]), ("2", [0, 1, 0]), ("3", [0, 0, 1])]
+    )
+    client.create_index()
+
+    def current_init_k():
+        with client.connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SHOW lantern_hnsw.init_k")
+                return cur.fetchone()[0]
+
+    assert len(client.search(query_embedding=[0, 0, 1], limit=2)) == 2
+    assert current_init_k() == "2"
+    assert len(client.search(query_embedding=[0, 0, 1], limit=2)) == 2
+    assert len(client.search(query_embedding=[0, 0, 1], limit=3)) == 3
+    assert current_init_k() == "3"
+
+    client.drop()
+    client.close()
+
+
+def test_prepared_statements():
+    client = SyncClient(
+        url=DB_URL,
+        table_name="small_world_prepared",
+        dimensions=3,
+        distance_type="l2sq",
+        max_db_connections=1,
+        prepare=True,
+    )
+    client.drop()
+    client.create_table()
+    client.bulk_insert(
+        [
+            ("1", [0, 0, 0], {"name": "a"}),
+            ("2", [0, 1, 0], {"name": "b"}),
+            ("10", [0, 0, 1], {"name": "c"}),
+        ]
+    )
+    client.create_index()
+
+    for _ in range(3):
+        assert client.get_by_id("10").id == "10"
+        assert len(client.get_by_ids(["1", "2"])) == 2
+        vectors = client.search(query_embedding=[0, 1, 0], limit=2, filter={"name": "b"})
+        assert len(vectors) == 1
+        assert vectors[0].id == "2"
+
+    vectors = client.search(query_id="10", limit=3)
+    assert vectors[0].id == "10"
+
+    with client.connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT count(*) FROM pg_prepared_statements WHERE name LIKE 'lantern_%'"
+            )
+            assert cur.fetchone()[0] == 4
+
+    # each limit is a distinct statement, the least recently used are deallocated
+    client.max_prepared_statements = 3
+    for limit in range(1, 6):
+        rows = client.search(query_embedding=[0, 1, 0], limit=limit)
+        assert len(rows) == min(limit, 3)
+    assert len(client.get_by_ids(["1", "2"])) == 2
+
+    with client.connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT count(*) FROM pg_prepared_statements WHERE name LIKE 'lantern_%'"
+            )
+            assert cur.fetchone()[0] == 3
+
+    client.drop()
+    client.close()
+
+
+def test_numpy_output():
+    client = SyncClient(
+        url=DB_URL,
+        table_name="small_world_numpy",
+        dimensions=3,
+        distance_type="l2sq",
+    )
+    client.drop()
+    client.create_table()
+    client.bulk_insert(
+        [
+            ("1", [0, 0, 0], {"name": "a"}),
+            ("2", [0, 1, 0], {"name": "b"}),
+            ("3", [0, 0, 1], {"name": "c"}),
+        ]
+    )
+    client.create_index()
+
+    result = client.get_by_ids(["1", "3"], output="numpy")
+    assert list(result.ids) == ["1", "3"]
+    assert result.embeddings.dtype == np.float32
+    assert result.embeddings.shape == (2, 3)
+    assert result.embeddings.flags["C_CONTIGUOUS"]
+    assert result.metadata == [{"name": "a"}, {"name": "c"}]
+    assert result.distances is None
+
+    result = client.search(
+        query_embedding=np.array([0, 1, 0], dtype=np.float32),
+        limit=2,
+        select_fields=["id", "embedding"],
+        output="numpy",
+    )
+    assert list(result.ids) == ["2", "1"]
+    assert np.array_equal(result.embeddings, np.array([[0, 1, 0], [0, 0, 0]]))
+    assert list(result.distances) == [0, 1]
+    assert result.metadata is None
+
+    result = client.get_by_ids(["4"], select_fields=["id", "embedding"], output="numpy")
+    assert result.embeddings.shape == (0, 3)
+
+    client.drop()
+
+
+def test_numpy_embeddings():
+    client = SyncClient(
+        url=DB_URL,
+        table_name="small_world_numpy_embeddings",
+        dimensions=3,
+        distance_type="l2sq",
+        numpy_embeddings=True,
+    )
+    client.drop()
+    client.create_table()
+    client.bulk_insert(
+        [
+            ("1", np.array([0, 0, 0], dtype=np.float32), {"name": "a"}),
+            ("2", np.array([0, 1, 0], dtype=np.float32), {"name": "b"}),
+            ("3", np.array([0, 0, 1.5], dtype=np.float32), {"name": "c"}),
+        ]
+    )
+    client.create_index()
+
+    vec_by_id = client.get_by_id("3")
+    assert isinstance(vec_by_id.embedding, np.ndarray)
+    assert vec_by_id.embedding.dtype == np.float32
+    assert np.array_equal(vec_by_id.embedding, [0, 0, 1.5])
+
+    vectors = client.get_by_ids(["1", "2"], select_fields=["id", "embedding"])
+    assert all(isinstance(v.embedding, np.ndarray) for v in vectors)
+
+    vectors = client.search(query_id="2", limit=2, select_fields=["id", "embedding"])
+    assert vectors[0].id == "2"
+    assert isinstance(vectors[0].embedding, np.ndarray)
+
+    client.drop()
+
+
+def test_upsert_update():
+    client = SyncClient(
+        url=DB_URL,
+        table_name="small_world_merge",
+        dimensions=3,
+        distance_type="l2sq",
+    )
+    client.drop()
+    client.create_table()
+    client.bulk_insert(
+        [
+            ("1", [0, 0, 0], {"name": "a"}),
+            ("2", [0, 1, 0], {"name": "b"}),
+        ]
+    )
+
+    client.upsert(("1", [1, 1, 1], {"name": "x"}))
+    assert client.get_by_id("1").metadata["name"] == "a"
+
+    client.upsert(("1", [1, 1, 1], {"name": "x"}), update=True)
+    vec_by_id = client.get_by_id("1")
+    assert vec_by_id.metadata["name"] == "x"
+    assert vec_by_id.embedding == [1, 1, 1]
+
+    changed = client.bulk_upsert(
+        [
+            ("1", [1, 1, 1], {"name": "x"}),
+            ("2", [0, 2, 0], {"name": "b"}),
+            ("3", [0, 0, 1], {"name": "c"}),
+            ("3", [0, 0, 3], {"name": "c"}),
+        ]
+    )
+    # "1" is unchanged and skipped, "2" is updated and "3" is inserted once
+    assert changed == 2
+    assert client.count() == 3
+    assert client.get_by_id("2").embedding == [0, 2, 0]
+    assert client.get_by_id("3").embedding == [0, 0, 3]
+
+    # within a batch the last row of an id wins an update, the first an insert
+    client.upsert_many(
+        [("2", [0, 4, 0], {"name": "b"}), ("2", [0, 5, 0], {"name": "b"})],
+        update=True,
+    )
+    assert client.get_by_id("2").embedding == [0, 5, 0]
+    client.upsert_many([("4", [4, 0, 0]), ("4", [5, 0, 0])])
+    assert client.get_by_id("4").embedding == [4, 0, 0]
+    assert client.count() == 4
+
+    client.drop()
+
+
+def test_update_many():
+    client = SyncClient(
+        url=DB_URL,
+        table_name="small_world_update_many",
+        dimensions=3,
+        distance_type="l2sq",
+    )
+    client.drop()
+    client.create_table()
+    client.bulk_insert(
+        [
+            ("1", [0, 0, 0], {"name": "a", "n": 1}),
+            ("2", [0, 1, 0], {"name": "b", "n": 2}),
+            ("3", [0, 0, 1], {"name": "c", "n": 3}),
+        ]
+    )
+
+    updated = client.update_many(
+        [
+            ("1", None, {"name": "x"}),
+            ("2", [1, 1, 1]),
+            ("3", [2, 2, 2], {"name": "z"}),
+            ("4", None, {"name": "missing"}),
+        ]
+    )
+    assert updated == 3
+    assert client.get_by_id("1").metadata == {"name": "x"}
+    assert client.get_by_id("1").embedding == [0, 0, 0]
+    assert client.get_by_id("2").embedding == [1, 1, 1]
+    assert client.get_by_id("2").metadata == {"name": "b", "n": 2}
+    assert client.get_by_id("3").embedding == [2, 2, 2]
+
+    client.update_many([("2", None, {"name": "y"})], merge_metadata=True)
+    assert client.get_by_id("2").metadata == {"name": "y", "n": 2}
+    assert client.count() == 3
+
+    client.drop()
+
+
+def test_search_cache():
+    cache = SearchCache(max_entries=2, ttl=60)
+    client = SyncClient(
+        url=DB_URL,
+        table_name="small_world_cache",
+        dimensions=3,
+        distance_type="l2sq",
+        cache=cache,
+    )
+    client.drop()
+    client.create_table()
+    client.bulk_insert([("1", [0, 0, 0]), ("2", [0, 1, 0]), ("3", [0, 0, 1])])
+    client.create_index()
+
+    vectors = client.search(query_embedding=[0, 1, 0], limit=1)
+    assert vectors[0].id == "2"
+    assert client.search(query_embedding=np.array([0, 1, 0]), limit=1) is vectors
+    assert cache.stats().hits == 1
+    assert cache.stats().misses == 1
+
+    # writes invalidate the cached results of the table
+    client.upsert(("4", [0, 1, 0]))
+    client.delete_by_ids(["2"])
+    assert client.search(query_embedding=[0, 1, 0], limit=1)[0].id == "4"
+    assert cache.stats().misses == 2
+
+    client.search(query_embedding=[0, 0, 1], limit=1)
+    client.search(query_embedding=[0, 0, 0], limit=1)
+    assert cache.stats().evictions == 1
+    assert cache.stats().entries == 2
+
+    client.drop()
+
+
+def test_replica_routing():
+    # the primary doubles as the replica, this only checks the routing
+    client = SyncClient(
+        url=DB_URL,
+        table_name="small_world_replicas",
+        dimensions=3,
+        distance_type="l2sq",
+        max_db_connections=2,
+        replica_urls=[DB_URL],
+        read_your_writes=60,
+    )
+    client.drop()
+    client.create_table()
+    client.bulk_insert([("1", [0, 0, 0]), ("2", [0, 1, 0])])
+
+    # reads right after a write are pinned to the primary
+    assert client.count() == 2
+    assert client.replica_pools[0] is None
+
+    client.read_your_writes = 0
+    assert client.count() == 2
+    assert client.search(query_embedding=[0, 1, 0], limit=1)[0].id == "2"
+    assert client.replica_pools[0] is not None
+
+    client.drop()
+    client.close()
+
+
+def test_connection_pool():
+    client = SyncClient(
+        url=DB_URL,
+        table_name="small_world_pool",
+        dimensions=3,
+        distance_type="l2sq",
+        max_db_connections=2,
+        pool_options={"timeout": 10},
+    )
+    client.drop()
+    client.create_table()
+    client.bulk_insert([("1", [0, 0, 0]), ("2", [0, 1, 0])])
+
+    # more threads than connections wait for a free one
+    errors = []
+
+    def worker():
+        try:
+            for _ in range(10):
+                assert client.search(query_embedding=[0, 1, 0], limit=1)[0].id == "2"
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    stats = client.pool.stats()
+    assert stats.size <= 2
+    assert stats.in_use == 0
+    assert stats.timeouts == 0
+    assert stats.checkouts >= 80
+    assert stats.checkout_latency.count == stats.checkouts
+
+    client.drop()
+    client.close()
+
+
+def test_lazy_pool_sizing():
+    client = SyncClient(url=DB_URL, table_name="small_world_lazy", dimensions=3)
+    assert client.pool is None
+
+    # the connection limit is probed on the first pooled connection
+    client.exists()
+    stats = client.pool.stats()
+    assert stats.connections_opened == 1
+    assert stats.max_size >= 1
+
+    # later pools reuse the cached limit
+    other = SyncClient(url=DB_URL, table_name="small_world_lazy", dimensions=3)
+    other.exists()
+    assert other.pool.stats().max_size == stats.max_size
+    assert other.pool.stats().connections_opened == 1
+
+    client.close()
+    other.close()
+
+
+def test_instrumentation():
+    class Recorder(Instrumentation):
+        def __init__(self):
+            self.started = []
+            self.events = []
+
+        def on_start(self, event):
+            self.started.append(event.operation)
+
+        def on_end(self, event):
+            self.events.append(event)
+
+    recorder = Recorder()
+    client = SyncClient(
+        url=DB_URL,
+        table_name="small_world_instrumented",
+        dimensions=3,
+        distance_type="l2sq",
+        instrumentation=recorder,
+    )
+    client.drop()
+    client.create_table()
+    client.bulk_insert([("1", [0, 0, 0]), ("2", [0, 1, 0])])
+    client.search(query_embedding=[0, 1, 0], limit=2)
+
+    assert recorder.started == [
+        "SyncClient.drop",
+        "SyncClient.create_table",
+        "SyncClient.bulk_insert",
+        "SyncClient.search",
+    ]
+    copy, search = recorder.events[2:]
+    assert copy.rows == 2
+    assert copy.bytes_sent > 0
+    assert search.rows == 2
+    assert search.attributes["limit"] == 2
+    assert search.error is None
+    for phase in ["build", "checkout", "settings", "execute", "fetch", "decode", "commit"]:
+        assert phase in search.timings
+    assert sum(search.timings.values()) <= search.duration
+
+    stats = StatsInstrumentation()
+    client.instrumentation = stats
+    client.search(query_embedding=[0, 1, 0], limit=1)
+    client.search(query_embedding=[0, 0, 0], limit=1)
+    assert stats.stats()["SyncClient.search"].calls == 2
+    assert stats.stats()["SyncClient.search"].rows == 2
+
+    client.drop()
+
+
+def test_benchmark():
+    dataset = generate_dataset(200, 8, num_queries=20, distance_type="l2sq")
+    truth = ground_truth(dataset.queries, dataset.embeddings, k=5)
+    distances = ((dataset.queries[:, None] - dataset.embeddings[None]) ** 2).sum(-1)
+    assert (truth[:, 0] == distances.argmin(axis=1)).all()
+
+    results = run_benchmark(
+        DB_URL,
+        dataset,
+        get_sweep(m=[4], ef_construction=[16], ef=[8, 64]),
+        k=5,
+        table_name="small_world_benchmark",
+        warmup=2,
+    )
+    assert results.rows == 200
+    assert [result.ef for result in results.results] == [8, 64]
+    for result in results.results:
+        assert 0 < result.recall <= 1
+        assert result.qps > 0
+        assert result.p50 <= result.p95 <= result.p99
+
+
+def test_search_ef():
+    client = SyncClient(
+        url=DB_URL,
+        table_name="small_world_ef",
+        dimensions=3,
+        distance_type="l2sq",
+        max_db_connections=1,
+    )
+    client.drop()
+    client.create_table()
+    # distinct distances, so the exact neighbors of every query have no ties
+    embeddings = np.random.default_rng(0).standard_normal((100, 3), np.float32)
+    client.bulk_insert(
+        [(str(i), embedding.tolist()) for i, embedding in enumerate(embeddings)]
+    )
+    client.create_index()
+
+    def show(setting):
+        with client.connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"SHOW {setting}")
+                return cur.fetchone()[0]
+
+    default_ef = show("lantern_hnsw.ef")
+    assert len(client.search(query_embedding=[0, 0, 1], limit=5, ef=32, init_k=20)) == 5
+    assert show("lantern_hnsw.ef") == "32"
+    assert show("lantern_hnsw.init_k") == "20"
+
+    # without an override the connection goes back to the default
+    client.search(query_embedding=[0, 0, 1], limit=5)
+    assert show("lantern_hnsw.ef") == default_ef
+    assert show("lantern_hnsw.init_k") == "5"
+
+    tuned = client.tune_ef(target_recall=0.9, limit=5, sample_size=20)
+    # the smallest ef reaching the target is chosen
+    assert tuned.recall >= 0.9
+    assert tuned.ef == tuned.trials[-1].ef
+    assert all(trial.recall < 0.9 for trial in tuned.trials[:-1])
+    assert client.search_ef == tuned.ef
+    assert [trial.ef for trial in tuned.trials] == sorted(
+        trial.ef for trial in tuned.trials
+    )
+
+    client.drop()
+    client.close()
+
+
+def test_metadata_filters():
+    client = SyncClient(
+        url=DB_URL,
+        table_name="small_world_filters",
+        dimensions=3,
+        distance_type="l2sq",
+    )
+    client.drop()
+    client.create_table()
+    client.bulk_insert(
+        [
+            ("1", [0, 0, 0], {"name": "a", "price": 5, "tags": ["x"]}),
+            ("2", [0, 1, 0], {"name": "b", "price": 15}),
+            ("3", [0, 0, 1], {"name": "c", "price": 25.5, "tags": ["y"]}),
+            ("4", [1, 1, 1], {"name": "d"}),
+        ]
+    )
+
+    def ids(filter):
+        results = client.search(
+            query_embedding=[0, 0, 0], limit=10, filter=filter, select_fields=["id"]
+        )
+        return sorted(row.id for row in results)
+
+    assert ids({"name": "a"}) == ["1"]
+    assert ids({"name": {"$eq": "a"}, "price": 5}) == ["1"]
+    assert ids({"name": {"$in": ["a", "c", "z"]}}) == ["1", "3"]
+    assert ids({"name": {"$nin": ["a", "b"]}}) == ["3", "4"]
+    assert ids({"name": {"$ne": "a"}}) == ["2", "3", "4"]
+    assert ids({"price": {"$gte": 15}}) == ["2", "3"]
+    assert ids({"price": {"$gt": 5, "$lt": 20}}) == ["2"]
+    assert ids({"name": {"$lt": "c"}}) == ["1", "2"]
+    assert ids({"tags": {"$exists": True}}) == ["1", "3"]
+    assert ids({"tags": {"$exists": False}}) == ["2", "4"]
+    assert ids({"tags": ["y"]}) == ["3"]
+    assert ids({"$or": [{"name": "a"}, {"price": {"$gt": 20}}]}) == ["1", "3"]
+    assert ids(
+        {"$and": [{"price": {"$exists": True}}, {"$or": [{"name": "b"}, {"name": "c"}]}]}
+    ) == ["2", "3"]
+
+    client.drop()
+
+
+def test_index_advisor():
+    usage = FilterUsage()
+    client = SyncClient(
+        url=DB_URL,
+        table_name="small_world_advisor",
+        dimensions=3,
+        distance_type="l2sq",
+        filter_usage=usage,
+    )
+    client.drop()
+    client.create_table()
+    client.bulk_insert(
+        [(str(i), [i, 0, 0], {"price": i, "name": f"n{i}"}) for i in range(10)]
+    )
+
+    client.search(query_embedding=[0, 0, 0], filter={"price": {"$gte": 3, "$lt": 8}})
+    client.search(query_embedding=[0, 0, 0], filter={"name": "n1"})
+    assert client.delete_by_metadata({"price": {"$gt": 8}}) == 1
+
+    keys = set((stat.key, stat.operator) for stat in usage.stats())
+    assert keys == {("price", "$gte"), ("price", "$lt"), ("price", "$gt"), ("name", "$eq")}
+
+    proposals = client.advise_indexes()
+    assert [(p.key, p.value_kind) for p in proposals] == [("price", "numeric")]
+    assert proposals[0].count == 3
+    assert proposals[0].exists is False
+
+    proposals = client.advise_indexes(create=True)
+    assert proposals[0].created
+    assert client.advise_indexes()[0].exists
+    assert len(client.search(query_embedding=[0, 0, 0], filter={"price": {"$lt": 2}})) == 2
+
+    client.drop()
+
+
+def test_adaptive_filtered_search():
+    class Recorder(Instrumentation):
+        def __init__(self):
+            self.searches = []
+
+        def on_end(self, event):
+            if event.operation == "SyncClient.search":
+                self.searches.append(event)
+
+    recorder = Recorder()
+    client = SyncClient(
+        url=DB_URL,
+        table_name="small_world_adaptive",
+        dimensions=3,
+        distance_type="l2sq",
+        filter_strategy="adaptive",
+        exact_search_rows=0,
+        max_init_k=200,
+        instrumentation=recorder,
+    )
+    client.drop()
+    client.create_table()
+    # one row in 20 is red, and the reds are the farthest from the query
+    client.bulk_insert(
+        [
+            (str(i), [i, 0, 0], {"color": "red" if i % 20 == 19 else "blue"})
+            for i in range(200)
+        ]
+    )
+    client.create_index()
+    with client.connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"ANALYZE {client.table_name}")
+
+    estimate = client.estimate_filter_selectivity({"color": "red"})
+    assert estimate.total_rows > 0
+    assert 0 < estimate.selectivity < 1
+    sampled = client.estimate_filter_selectivity({"color": "red"}, method="sample")
+    assert 0 <= sampled.selectivity <= 1
+
+    filter = {"color": "red"}
+    expected = ["19", "39", "59", "79", "99"]
+
+    # the first index candidates are all blue, so filtering them falls short
+    rows = client.search(
+        query_embedding=[0, 0, 0],
+        limit=5,
+        init_k=10,
+        filter=filter,
+        filter_strategy="index",
+    )
+    assert len(rows) < 5
+
+    # the adaptive search raises init_k from 10 until 5 candidates are red
+    rows = client.search(query_embedding=[0, 0, 0], limit=5, init_k=10, filter=filter)
+    assert [row.id for row in rows] == expected
+    attributes = recorder.searches[-1].attributes
+    assert attributes["filter_strategy"] == "adaptive"
+    assert attributes["attempts"] == 3
+    assert attributes["init_k"] == 160
+
+    # without init_k it is sized from the selectivity and one pass is enough
+    rows = client.search(query_embedding=[0, 0, 0], limit=5, filter=filter)
+    assert [row.id for row in rows] == expected
+    assert recorder.searches[-1].attributes["attempts"] == 1
+
+    rows = client.search(
+        query_embedding=[0, 0, 0], limit=5, filter=filter, filter_strategy="exact"
+    )
+    assert [row.id for row in rows] == expected
+    result = client.search(
+        query_embedding=[0, 0, 0], limit=5, filter=filter, output="numpy"
+    )
+    assert list(result.ids) == expected
+
+    try:
+        client.search(query_embedding=[0, 0, 0], filter=filter, filter_strategy="x")
+        assert False
+    except Exception as e:
+        assert "Invalid filter strategy" in str(e)
+
+    client.drop()
+
+
+def test_hybrid_search():
+    client = SyncClient(
+        url=DB_URL,
+        table_name="small_world_hybrid",
+        dimensions=3,
+        distance_type="l2sq",
+        text_field="text",
+    )
+    client.drop()
+    client.create_table()
+    client.bulk_insert(
+        [
+            ("1", [0, 0, 0], {"text": "red apples and pears", "kind": "fruit"}),
+            ("2", [1, 0, 0], {"text": "green apples", "kind": "fruit"}),
+            ("3", [2, 0, 0], {"text": "a red car", "kind": "car"}),
+            ("4", [9, 0, 0], {"text": "fresh pears", "kind": "fruit"}),
+        ]
+    )
+    client.create_index()
+
+    # only the nearest row is both near and a text match
+    rows = client.hybrid_search("pears", [0, 0, 0], limit=2, candidates=2)
+    assert rows[0].id == "1"
+    assert rows[0].score > rows[1].score
+    assert rows[0].metadata.kind == "fruit"
+
+    # the text match far from the query still ranks
+    rows = client.hybrid_search(
+        "pears", [0, 0, 0], limit=4, candidates=2, vector_weight=0.1
+    )
+    assert set(row.id for row in rows[:2]) == {"1", "4"}
+
+    rows = client.hybrid_search(
+        "red", [0, 0, 0], limit=3, filter={"kind": "car"}, fusion="weighted"
+    )
+    assert [row.id for row in rows] == ["3"]
+
+    result = client.hybrid_search(
+        "apples", [0, 0, 0], limit=2, select_fields=["id"], output="numpy"
+    )
+    assert sorted(result.ids) == ["1", "2"]
+    assert result.scores.shape == (2,)
+
+    client.drop()
+
+
+def test_quantized_search():
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((200, 64)).astype(np.float32)
+    client = SyncClient(
+        url=DB_URL,
+        table_name="small_world_quantized",
+        dimensions=64,
+        distance_type="l2sq",
+        quantization="binary",
+        oversampling=10,
+    )
+    client.drop()
+    client.create_table()
+    client.bulk_insert(
+        (str(i), embedding.tolist(), {"even": i % 2 == 0})
+        for i, embedding in enumerate(embeddings[:100])
+    )
+    client.bulk_insert_binary(
+        [str(i) for i in range(100, 190)], embeddings[100:190]
+    )
+    client.upsert_many(
+        [(str(i), embeddings[i].tolist()) for i in range(190, 200)]
+    )
+    client.create_index()
+    assert client.count() == 200
+
+    # results are reranked by their exact distance
+    truth = ground_truth(embeddings[:5], embeddings, 5)
+    for query, expected in zip(embeddings[:5], truth):
+        rows = client.search(query_embedding=query, limit=5, select_fields=["id"])
+        assert rows[0].id == str(expected[0])
+        distances = [row.distance for row in rows]
+        assert distances == sorted(distances)
+
+    results = client.search_many(embeddings[:5], limit=3, select_fields=["id"])
+    assert [rows[0].id for rows in results] == [str(i) for i in range(5)]
+
+    # the candidates come from the hamming index on the bits
+    query, params = client.builder.search_query(
+        embeddings[0].tolist(), limit=5, select=["id"]
+    )
+    query, params = translate_to_pyformat(query, params)
+    with client.connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SET LOCAL enable_seqscan = off; EXPLAIN " + query, params)
+            plan = "\n".join(row[0] for row in cur.fetchall())
+    assert "small_world_quantized_embedding_idx" in plan
+
+    rows = client.search(query_id="3", limit=1, filter={"even": False})
+    assert rows[0].id == "3"
+
+    # updated embeddings get new bits
+    client.update_by_id("0", embeddings[150].tolist())
+    rows = client.search(query_embedding=embeddings[150], limit=2, select_fields=["id"])
+    assert set(row.id for row in rows) == {"0", "150"}
+
+    client.drop()
+
+
+def test_partitioned_table():
+    class Recorder(Instrumentation):
+        def __init__(self):
+            self.searches = []
+
+        def on_end(self, event):
+            if event.operation == "SyncClient.search":
+                self.searches.append(event)
+
+    recorder = Recorder()
+    client = SyncClient(
+        url=DB_URL,
+        table_name="small_world_partitioned",
+        dimensions=3,
+        distance_type="l2sq",
+        partition_key="tenant",
+        partition_by="list",
+        partitions=["a", "b"],
+        instrumentation=recorder,
+    )
+    client.drop()
+    client.create_table()
+    client.bulk_insert(
+        (str(i), [i, 0, 0], {"tenant": "a" if i % 2 == 0 else "b"}) for i in range(10)
+    )
+    client.upsert(("10", [10, 0, 0], {"tenant": "c"}))
+    client.create_index()
+    assert client.count() == 11
+    assert client.builder.get_partition_names() == [
+        "small_world_partitioned_p0",
+        "small_world_partitioned_p1",
+        "small_world_partitioned_default",
+    ]
+
+    # without the partition key every partition is searched and merged
+    rows = client.search(query_embedding=[0, 0, 0], limit=4, select_fields=["id"])
+    assert [row.id for row in rows] == ["0", "1", "2", "3"]
+    # the work of the partition threads is reported on the search event
+    event = recorder.searches[-1]
+    assert event.attributes["partitions"] == 3
+    assert event.rows == 4 + 4 + 1
+    assert event.bytes_sent > 0
+    timings = event.attributes["partition_timings"]
+    assert sorted(timings) == sorted(client.builder.get_partition_names())
+    assert all("execute" in phases for phases in timings.values())
+    assert sum(event.timings.values()) <= event.duration
+    rows = client.search(query_embedding=[10, 0, 0], limit=1, select_fields=["id"])
+    assert rows[0].id == "10"
+    rows = client.search(query_id="5", limit=2, select_fields=["id"])
+    assert rows[0].id == "5" and rows[1].id in ("4", "6")
+
+    # with it only the matching partition is searched
+    rows = client.search(
+        query_embedding=[0, 0, 0], limit=3, filter={"tenant": "b"}, select_fields=["id"]
+    )
+    assert [row.id for row in rows] == ["1", "3", "5"]
+
+    client.update_by_id("1", metadata={"tenant": "a"})
+    rows = client.search(
+        query_embedding=[0, 0, 0], limit=2, filter={"tenant": "a"}, select_fields=["id"]
+    )
+    assert [row.id for row in rows] == ["0", "1"]
+
+    assert client.reindex_partitions(["small_world_partitioned_p0"]) == [
+        "small_world_partitioned_p0"
+    ]
+
+    # ids stay unique when the partition key of a row changes
+    client.upsert(("2", [2, 0, 0], {"tenant": "b"}))
+    assert client.get_by_id("2").metadata == {"tenant": "a"}
+    client.upsert(("2", [2, 0, 0], {"tenant": "b"}), update=True)
+    client.upsert_many(
+        [("4", [4, 0, 0], {"tenant": "c"}), ("4", [4, 0, 0], {"tenant": "b"})],
+        update=True,
+    )
+    client.bulk_upsert([("6", [6, 0, 0], {"tenant": "c"})])
+    assert client.count() == 11
+    for id, tenant in (("2", "b"), ("4", "b"), ("6", "c")):
+        rows = client.get_by_ids([id])
+        assert len(rows) == 1 and rows[0].metadata == {"tenant": tenant}
+    rows = client.search(query_id="6", limit=1, select_fields=["id"])
+    assert rows[0].id == "6"
+    rows = client.search(
+        query_embedding=[4, 0, 0], limit=1, filter={"tenant": "b"}, select_fields=["id"]
+    )
+    assert rows[0].id == "4"
+
+    # rows without the partition key are rejected before they are written
+    for write in (
+        lambda: client.upsert(("11", [11, 0, 0], {"color": "red"})),
+        lambda: client.bulk_insert([("11", [11, 0, 0])]),
+        lambda: client.update_by_id("0", metadata={"color": "red"}),
+    ):
+        try:
+            write()
+            assert False, "Rows without the partition key must be rejected"
+        except Exception as e:
+            assert "'tenant'" in str(e)
+    assert client.count() == 11
+    client.update_many([("0", None, {"color": "red"})], merge_metadata=True)
+    assert client.get_by_id("0").metadata == {"tenant": "a", "color": "red"}
+
+    client.drop()
@@ -0,0 +1,129 @@
+import asyncio
+import threading
+from lantern import AsyncClient
+import os
+
+DB_URL = os.environ.get("DB_URL")
+
+if DB_URL is None:
+    raise (Exception("Please provide 'DB_URL' env variable"))
+
+
+async def run_client():
+    client = AsyncClient(
+        url=DB_URL,
+        table_name="small_world_async",
+        dimensions=3,
+        distance_type="l2sq",
+        m=12,
+        ef=64,
+        ef_construction=64,
+    )
+
+    try:
+        await client.drop()
+    except:
+        pass
+
+    await client.create_table()
+
+    await client.bulk_insert(
+        [
+            ("1", [0, 0, 0], {"name": "a"}),
+            ("2", [0, 1, 0], {"name": "b"}),
+            ("3", [0, 0, 1], {"name": "c"}),
+        ]
+    )
+
+    await client.create_index()
+
+    vec_by_id = await client.get_by_id(id="1", select_fields=["id", "metadata"])
+    assert vec_by_id.embedding is None
+    assert vec_by_id.metadata["name"] == "a"
+
+    vectors_by_ids = await client.get_by_ids(["1", "3"])
+    assert len(vectors_by_ids) == 2
+
+    await client.upsert(("4", [1, 0, 0], {"name": "d"}))
+    await client.upsert_many([("5", [1, 1, 0], {"name": "e"})])
+    await client.update_by_id(id="4", metadata={"name": "4"})
+    assert await client.count() == 5
+
+    await client.delete_by_ids(["5"])
+    assert await client.count() == 4
+
+    vectors = await client.search(query_id="4")
+    assert len(vectors) == 4
+    assert vectors[0].id == "4"
+    assert vectors[0].distance == 0
+
+    # Many searches in flight on one event loop
+    results = await asyncio.gather(
+        *[client.search(query_embedding=[0, 1, 0], limit=1) for _ in range(20)]
+    )
+    assert all(r[0].id == "2" for r in results)
+
+    vectors = await client.search(
+        query_embedding=[1, 0, 0], limit=2, filter={"name": "a"}, select_fields=["id"]
+    )
+    assert len(vectors) == 1
+    assert vectors[0].id == "1"
+
+    # concurrent first calls on an unopened client share one pool
+    fresh = AsyncClient(
+        url=DB_URL, table_name="small_world_async", dimensions=3, distance_type="l2sq"
+    )
+    opened = []
+    open_pool = fresh._open_pool
+
+    async def counting_open_pool():
+        opened.append(True)
+        return await open_pool()
+
+    fresh._open_pool = counting_open_pool
+    counts = await asyncio.gather(*[fresh.count() for _ in range(10)])
+    assert counts == [4] * 10
+    assert len(opened) == 1
+    await fresh.close()
+
+    await client.drop()
+    await client.close()
+
+
+def test_async_client():
+    asyncio.run(run_client())
+
+
+def test_async_client_created_outside_event_loop():
+    # the client is created with no running event loop, here in a thread
+    # without one, and first used by concurrent calls in asyncio.run
+    clients = []
+    thread = threading.Thread(
+        target=lambda: clients.append(
+            AsyncClient(
+                url=DB_URL,
+                table_name="small_world_async_loop",
+                dimensions=3,
+                distance_type="l2sq",
+            )
+        )
+    )
+    thread.start()
+    thread.join()
+    client = clients[0]
+    opened = []
+    open_pool = client._open_pool
+
+    async def counting_open_pool():
+        opened.append(True)
+        return await open_pool()
+
+    client._open_pool = counting_open_pool
+
+    async def run():
+        results = await asyncio.gather(*[client.exists() for _ in range(10)])
+        assert results == [False] * 10
+        assert len(opened) == 1
+        await client.close()
+
+    asyncio.run(run())